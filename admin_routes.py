@@ -1,17 +1,69 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, status
+from fastapi.responses import PlainTextResponse, Response
 from sqlalchemy.orm import Session
-from typing import List
-from database import get_db, Station, Student, Bus, Admin
+from typing import List, Optional
+from database import get_db, get_read_db, Station, Student, StudentAlert, Bus, Admin
 from models import (
     StationCreate, StationResponse, StationUpdate,
     StudentCreate, StudentResponse,
     BusCreate, BusResponse,
-    AdminCreate
+    AdminCreate, PageResponse, RouteImportResponse
 )
-from auth import get_current_admin, get_password_hash
+from auth import get_current_admin, get_optional_admin, get_password_hash
+from pagination import paginate, select_fields, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from config import DEFAULT_DISTRICT_ID
+import geofence
+import profiling
+import route_import
+import snapshots
 
 router = APIRouter(prefix="/admin", tags=["admin"])
 
+# Fields clients may request through the `fields` projection parameter
+STUDENT_FIELDS = ("id", "name", "username", "assigned_bus_id", "assigned_station_id", "district_id")
+BUS_FIELDS = ("id", "bus_number", "driver_name", "driver_phone", "district_id")
+STATION_FIELDS = ("id", "name", "latitude", "longitude", "bus_id", "order_number", "district_id")
+
+# Paged queries, shared with the admin GUI data endpoints in main.py
+def student_page(db: Session, cursor=None, limit=DEFAULT_PAGE_SIZE, bus_id=None,
+                 station_id=None, name_prefix=None, fields=None, district_id=None) -> dict:
+    filters = []
+    if district_id is not None:
+        filters.append(Student.district_id == district_id)
+    if bus_id is not None:
+        filters.append(Student.assigned_bus_id == bus_id)
+    if station_id is not None:
+        filters.append(Student.assigned_station_id == station_id)
+    if name_prefix:
+        filters.append(Student.name.startswith(name_prefix, autoescape=True))
+    return paginate(db, Student, select_fields(fields, STUDENT_FIELDS), filters, cursor, limit)
+
+def bus_page(db: Session, cursor=None, limit=DEFAULT_PAGE_SIZE, bus_number_prefix=None,
+             fields=None, district_id=None) -> dict:
+    filters = []
+    if district_id is not None:
+        filters.append(Bus.district_id == district_id)
+    if bus_number_prefix:
+        filters.append(Bus.bus_number.startswith(bus_number_prefix, autoescape=True))
+    return paginate(db, Bus, select_fields(fields, BUS_FIELDS), filters, cursor, limit)
+
+def station_page(db: Session, cursor=None, limit=DEFAULT_PAGE_SIZE, bus_id=None,
+                 name_prefix=None, fields=None, district_id=None) -> dict:
+    filters = []
+    if district_id is not None:
+        filters.append(Station.district_id == district_id)
+    if bus_id is not None:
+        filters.append(Station.bus_id == bus_id)
+    if name_prefix:
+        filters.append(Station.name.startswith(name_prefix, autoescape=True))
+    return paginate(db, Station, select_fields(fields, STATION_FIELDS), filters, cursor, limit)
+
+def route_changed(db: Session, bus_ids):
+    """Invalidate per-bus caches after stations or rider assignments change; commit afterwards"""
+    snapshots.invalidate(db, bus_ids)
+    geofence.invalidate(bus_ids)
+
 # Station management
 @router.post("/stations", response_model=StationResponse)
 def create_station(
@@ -19,24 +71,43 @@ def create_station(
     db: Session = Depends(get_db),
     current_admin = Depends(get_current_admin)
 ):
-    # Verify bus exists
-    bus = db.query(Bus).filter(Bus.id == station.bus_id).first()
+    # Verify bus exists in the admin's district
+    bus = db.query(Bus).filter(
+        Bus.id == station.bus_id,
+        Bus.district_id == current_admin.district_id
+    ).first()
     if not bus:
         raise HTTPException(status_code=404, detail="Bus not found")
     
-    db_station = Station(**station.dict())
+    db_station = Station(**station.dict(), district_id=bus.district_id)
     db.add(db_station)
+    route_changed(db, [db_station.bus_id])
     db.commit()
     db.refresh(db_station)
     return db_station
 
+@router.get("/stations", response_model=PageResponse)
+def list_all_stations(
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    bus_id: Optional[int] = None,
+    name_prefix: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_read_db),
+    current_admin = Depends(get_current_admin)
+):
+    return station_page(db, cursor, limit, bus_id, name_prefix, fields, current_admin.district_id)
+
 @router.get("/stations/{bus_id}", response_model=List[StationResponse])
 def list_stations(
     bus_id: int,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_admin = Depends(get_current_admin)
 ):
-    stations = db.query(Station).filter(Station.bus_id == bus_id).order_by(Station.order_number).all()
+    stations = db.query(Station).filter(
+        Station.bus_id == bus_id,
+        Station.district_id == current_admin.district_id
+    ).order_by(Station.order_number).all()
     return stations
 
 @router.put("/stations/{station_id}", response_model=StationResponse)
@@ -46,7 +117,10 @@ def update_station(
     db: Session = Depends(get_db),
     current_admin = Depends(get_current_admin)
 ):
-    db_station = db.query(Station).filter(Station.id == station_id).first()
+    db_station = db.query(Station).filter(
+        Station.id == station_id,
+        Station.district_id == current_admin.district_id
+    ).first()
     if not db_station:
         raise HTTPException(status_code=404, detail="Station not found")
     
@@ -54,6 +128,7 @@ def update_station(
     for key, value in update_data.items():
         setattr(db_station, key, value)
     
+    route_changed(db, [db_station.bus_id])
     db.commit()
     db.refresh(db_station)
     return db_station
@@ -64,14 +139,47 @@ def delete_station(
     db: Session = Depends(get_db),
     current_admin = Depends(get_current_admin)
 ):
-    db_station = db.query(Station).filter(Station.id == station_id).first()
+    db_station = db.query(Station).filter(
+        Station.id == station_id,
+        Station.district_id == current_admin.district_id
+    ).first()
     if not db_station:
         raise HTTPException(status_code=404, detail="Station not found")
     
+    # Alerts reference the station; the feed entries go with it
+    db.query(StudentAlert).filter(StudentAlert.station_id == station_id).delete(synchronize_session=False)
     db.delete(db_station)
+    route_changed(db, [db_station.bus_id])
     db.commit()
     return {"message": "Station deleted successfully"}
 
+# Bulk route import
+def _import_routes(db: Session, routes: dict, district_id: int, dry_run: bool) -> dict:
+    diffs = route_import.plan_import(db, routes, district_id)
+    if not dry_run:
+        route_import.apply_import(db, diffs)
+        # One invalidation for every bus touched, not one per station
+        route_changed(db, [diff.bus_id for diff in diffs])
+        db.commit()
+    return {"dry_run": dry_run, "buses": [diff.summary() for diff in diffs]}
+
+@router.post("/routes/import", response_model=RouteImportResponse)
+async def import_routes(
+    request: Request,
+    format: Optional[str] = None,
+    dry_run: bool = False,
+    db: Session = Depends(get_db),
+    current_admin = Depends(get_current_admin)
+):
+    """
+    Replace the routes of one or more buses from JSON, CSV or GeoJSON
+    Format comes from `format` or the Content-Type; see route_import.py
+    """
+    body = await request.body()
+    format = format or route_import.detect_format(request.headers.get("content-type", ""), body)
+    routes = route_import.parse_routes(body, format)
+    return await asyncio.to_thread(_import_routes, db, routes, current_admin.district_id, dry_run)
+
 # Student management
 @router.post("/students", response_model=StudentResponse)
 def create_student(
@@ -83,15 +191,21 @@ def create_student(
     if db.query(Student).filter(Student.username == student.username).first():
         raise HTTPException(status_code=400, detail="Username already registered")
     
-    # Verify bus exists if assigned
+    # Verify bus exists in the admin's district if assigned
     if student.assigned_bus_id:
-        bus = db.query(Bus).filter(Bus.id == student.assigned_bus_id).first()
+        bus = db.query(Bus).filter(
+            Bus.id == student.assigned_bus_id,
+            Bus.district_id == current_admin.district_id
+        ).first()
         if not bus:
             raise HTTPException(status_code=404, detail="Bus not found")
     
-    # Verify station exists if assigned
+    # Verify station exists in the admin's district if assigned
     if student.assigned_station_id:
-        station = db.query(Station).filter(Station.id == student.assigned_station_id).first()
+        station = db.query(Station).filter(
+            Station.id == student.assigned_station_id,
+            Station.district_id == current_admin.district_id
+        ).first()
         if not station:
             raise HTTPException(status_code=404, detail="Station not found")
     
@@ -101,20 +215,28 @@ def create_student(
         username=student.username,
         password_hash=hashed_password,
         assigned_bus_id=student.assigned_bus_id,
-        assigned_station_id=student.assigned_station_id
+        assigned_station_id=student.assigned_station_id,
+        district_id=current_admin.district_id
     )
     db.add(db_student)
+    if student.assigned_bus_id:
+        geofence.invalidate([student.assigned_bus_id])
     db.commit()
     db.refresh(db_student)
     return db_student
 
-@router.get("/students", response_model=List[StudentResponse])
+@router.get("/students", response_model=PageResponse)
 def list_students(
-    db: Session = Depends(get_db),
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    bus_id: Optional[int] = None,
+    station_id: Optional[int] = None,
+    name_prefix: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_read_db),
     current_admin = Depends(get_current_admin)
 ):
-    students = db.query(Student).all()
-    return students
+    return student_page(db, cursor, limit, bus_id, station_id, name_prefix, fields, current_admin.district_id)
 
 # Bus management
 @router.post("/buses", response_model=BusResponse)
@@ -127,36 +249,94 @@ def create_bus(
     if db.query(Bus).filter(Bus.bus_number == bus.bus_number).first():
         raise HTTPException(status_code=400, detail="Bus number already exists")
     
-    db_bus = Bus(**bus.dict())
+    db_bus = Bus(**bus.dict(), district_id=current_admin.district_id)
     db.add(db_bus)
     db.commit()
     db.refresh(db_bus)
     return db_bus
 
-@router.get("/buses", response_model=List[BusResponse])
+@router.get("/buses", response_model=PageResponse)
 def list_buses(
-    db: Session = Depends(get_db),
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    bus_number_prefix: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_read_db),
     current_admin = Depends(get_current_admin)
 ):
-    buses = db.query(Bus).all()
-    return buses
+    return bus_page(db, cursor, limit, bus_number_prefix, fields, current_admin.district_id)
+
+# Request profiles
+@router.post("/profiles/token")
+def create_profile_token(current_admin = Depends(get_current_admin)):
+    """Signed X-Profile header value that forces profiling of a request"""
+    return {"header": "X-Profile", "value": profiling.create_profile_token()}
+
+@router.get("/profiles")
+def list_profiles(current_admin = Depends(get_current_admin)):
+    return profiling.list_profiles()
+
+@router.get("/profiles/{profile_id}")
+def download_profile(
+    profile_id: int,
+    format: str = "text",
+    current_admin = Depends(get_current_admin)
+):
+    profile = profiling.get_profile(profile_id)
+    if not profile:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    
+    if format == "prof":
+        # Raw cProfile stats, loadable with pstats or snakeviz
+        if profile["mode"] != "cprofile":
+            raise HTTPException(status_code=400, detail="Only cprofile profiles have .prof data")
+        return Response(
+            profile["data"],
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f"attachment; filename=profile-{profile_id}.prof"}
+        )
+    if format == "collapsed":
+        if profile["mode"] != "sample":
+            raise HTTPException(status_code=400, detail="Only sampled profiles have collapsed stacks")
+        lines = [f"{stack} {count}" for stack, count in profile["data"].items()]
+        return PlainTextResponse("\n".join(lines) + "\n")
+    return PlainTextResponse(profiling.render_profile(profile))
 
 # Admin creation (for initial setup)
+def new_admin_district(db: Session, current_admin, requested: Optional[int]) -> int:
+    """
+    District of a new admin: the creator's own
+    The very first admin needs no token and belongs to DEFAULT_DISTRICT_ID;
+    admins of DEFAULT_DISTRICT_ID may open another district
+    """
+    if current_admin is None:
+        if db.query(Admin).first():
+            raise HTTPException(status_code=403, detail="Admin already exists")
+        return DEFAULT_DISTRICT_ID
+    if requested is None or requested == current_admin.district_id:
+        return current_admin.district_id
+    if current_admin.district_id != DEFAULT_DISTRICT_ID:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    return requested
+
 @router.post("/create-admin")
 def create_admin(
     admin: AdminCreate,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    current_admin = Depends(get_optional_admin)
 ):
-    # Check if any admin exists (only allow if no admins exist)
-    existing_admin = db.query(Admin).first()
-    if existing_admin:
-        raise HTTPException(status_code=403, detail="Admin already exists")
+    district_id = new_admin_district(db, current_admin, admin.district_id)
+    
+    # Usernames are global; login doesn't name a district
+    if db.query(Admin).filter(Admin.username == admin.username).first():
+        raise HTTPException(status_code=400, detail="Username already registered")
     
     hashed_password = get_password_hash(admin.password)
     db_admin = Admin(
         username=admin.username,
         password_hash=hashed_password,
-        is_admin=True
+        is_admin=True,
+        district_id=district_id
     )
     db.add(db_admin)
     db.commit()
@@ -0,0 +1,338 @@
+"""
+Admission control for GPS ingest (/bus/update, /bus/update/batch and the
+simulator form)
+
+Runs as ASGI middleware on the event loop, so requests that are refused
+never take a threadpool thread or a database connection:
+
+1. Rate limits: a token bucket per bus and one for the whole fleet, each
+   fix costing one token. Over-limit requests get 429 with Retry-After;
+   a request needing more tokens than a bucket holds, or a body over
+   INGEST_MAX_BODY_BYTES, gets 413.
+2. Bounded ingest queue: at most INGEST_MAX_IN_FLIGHT ingest requests run
+   at once and up to INGEST_MAX_QUEUE wait for a slot. When the writer
+   falls behind, requests beyond the queue, or waiting longer than
+   INGEST_QUEUE_TIMEOUT_SECONDS, get 503 with Retry-After. Their tokens
+   are refunded, so a client retrying after a 503 is not limited for
+   fixes that were never stored.
+
+Keeping INGEST_MAX_IN_FLIGHT below the threadpool and connection pool
+sizes leaves room for student reads while ingest is being hammered.
+
+Buckets live in worker memory, so limits apply per worker. With
+ADMISSION_REDIS_URL set they are shared through Redis (the `redis`
+package is only imported then); if Redis fails, the worker falls back to
+its in-memory buckets.
+"""
+import asyncio
+import json
+import math
+import threading
+import time
+from collections import Counter as Tally, deque
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+from config import (
+    INGEST_BUS_RATE, INGEST_BUS_BURST, INGEST_GLOBAL_RATE, INGEST_GLOBAL_BURST,
+    INGEST_MAX_IN_FLIGHT, INGEST_MAX_QUEUE, INGEST_QUEUE_TIMEOUT_SECONDS,
+    INGEST_MAX_BODY_BYTES, ADMISSION_REDIS_URL
+)
+import metrics
+
+INGEST_PATHS = ("/bus/update", "/bus/update/batch", "/gui/bus-simulator/update")
+
+# Forget full, idle per-bus buckets beyond this many (bus ids come from clients)
+MAX_BUCKETS = 10000
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount: float) -> float:
+        """Take `amount` tokens; returns 0 on success, else seconds until they would be available"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.rate
+
+    def refund(self, amount: float):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + amount)
+
+    def is_full(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+class MemoryBuckets:
+    def __init__(self):
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def _bucket(self, key: str, rate: float, burst: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= MAX_BUCKETS:
+                for idle in [k for k, b in self._buckets.items() if b.is_full()]:
+                    del self._buckets[idle]
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    async def take(self, key: str, rate: float, burst: float, amount: float) -> float:
+        return self._bucket(key, rate, burst).take(amount)
+
+    async def refund(self, key: str, rate: float, burst: float, amount: float):
+        self._bucket(key, rate, burst).refund(amount)
+
+# Token bucket in a Redis hash; negative amounts refund. Uses the server
+# clock so workers with skewed clocks agree.
+_REDIS_TAKE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local amount = tonumber(ARGV[3])
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(state[1]) or burst
+local updated = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= amount then
+    tokens = math.min(burst, tokens - amount)
+else
+    wait = (amount - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "updated", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+class RedisBuckets:
+    """Buckets shared by every worker; falls back to memory when Redis errors"""
+
+    def __init__(self, url: str):
+        import redis.asyncio
+        self.client = redis.asyncio.from_url(url)
+        self.fallback = MemoryBuckets()
+
+    async def take(self, key: str, rate: float, burst: float, amount: float) -> float:
+        try:
+            wait = await self.client.eval(_REDIS_TAKE, 1, f"ingest:bucket:{key}", rate, burst, amount)
+            return float(wait)
+        except Exception:
+            metrics.ADMISSION_BACKEND_ERRORS.inc()
+            return await self.fallback.take(key, rate, burst, amount)
+
+    async def refund(self, key: str, rate: float, burst: float, amount: float):
+        try:
+            await self.client.eval(_REDIS_TAKE, 1, f"ingest:bucket:{key}", rate, burst, -amount)
+        except Exception:
+            metrics.ADMISSION_BACKEND_ERRORS.inc()
+            await self.fallback.refund(key, rate, burst, amount)
+
+class IngestGate:
+    """At most `max_in_flight` ingest requests at once, `max_queue` waiting (event loop only)"""
+
+    def __init__(self, max_in_flight: int, max_queue: int, timeout: float):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiters: Deque[asyncio.Future] = deque()
+
+    async def acquire(self) -> Optional[str]:
+        """Returns None once a slot is held, else the reason the request is shed"""
+        if self.max_in_flight <= 0 or (self.in_flight < self.max_in_flight and not self.waiters):
+            self.in_flight += 1
+            return None
+        if len(self.waiters) >= self.max_queue:
+            return "queue_full"
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            # release() hands its slot straight to the waiter
+            await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+            return None
+        except asyncio.TimeoutError:
+            self._abandon(waiter)
+            return "queue_timeout"
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+
+    def _abandon(self, waiter: asyncio.Future):
+        if waiter.done() and not waiter.cancelled():
+            # Granted just as we gave up; pass the slot on
+            self.release()
+            return
+        waiter.cancel()
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.in_flight -= 1
+
+buckets = RedisBuckets(ADMISSION_REDIS_URL) if ADMISSION_REDIS_URL else MemoryBuckets()
+gate = IngestGate(INGEST_MAX_IN_FLIGHT, INGEST_MAX_QUEUE, INGEST_QUEUE_TIMEOUT_SECONDS)
+
+def fixes_per_bus(path: str, body: bytes) -> Dict[str, int]:
+    """Fix count per bus id in an ingest request; unparseable bodies count as one anonymous fix"""
+    try:
+        if path == "/gui/bus-simulator/update":
+            bus_ids = parse_qs(body.decode())["bus_id"][:1]
+        elif path == "/bus/update/batch":
+            bus_ids = [location["bus_id"] for location in json.loads(body)["locations"]]
+        else:
+            bus_ids = [json.loads(body)["bus_id"]]
+    except (ValueError, KeyError, TypeError):
+        # Let the route answer with its usual validation error
+        return {"": 1}
+    return dict(Tally(str(bus_id) for bus_id in bus_ids))
+
+# (bucket key, rate, burst, tokens taken)
+Charge = Tuple[str, float, float, float]
+
+async def refund_rates(taken: List[Charge]):
+    """Give back tokens charged for a request that was not ingested"""
+    for key, rate, burst, amount in taken:
+        await buckets.refund(key, rate, burst, amount)
+
+async def check_rates(counts: Dict[str, int]) -> Tuple[Optional[str], float, List[Charge]]:
+    """
+    Charge the per-bus and global buckets one token per fix
+    Returns (shed reason, retry after seconds, tokens taken); reasons ending
+    in _burst mean the request is larger than a bucket can ever hold. Nothing
+    stays taken when the request is shed here.
+    """
+    # Larger than a bucket holds: could never be admitted, however long the client waits
+    if INGEST_BUS_RATE > 0 and any(amount > INGEST_BUS_BURST for bus_id, amount in counts.items() if bus_id):
+        return "bus_burst", 0.0, []
+    if INGEST_GLOBAL_RATE > 0 and sum(counts.values()) > INGEST_GLOBAL_BURST:
+        return "global_burst", 0.0, []
+
+    taken: List[Charge] = []
+    if INGEST_BUS_RATE > 0:
+        for bus_id, amount in counts.items():
+            if not bus_id:
+                continue
+            wait = await buckets.take(f"bus:{bus_id}", INGEST_BUS_RATE, INGEST_BUS_BURST, amount)
+            if wait > 0:
+                await refund_rates(taken)
+                return "bus_rate", wait, []
+            taken.append((f"bus:{bus_id}", INGEST_BUS_RATE, INGEST_BUS_BURST, amount))
+
+    if INGEST_GLOBAL_RATE > 0:
+        amount = sum(counts.values())
+        wait = await buckets.take("global", INGEST_GLOBAL_RATE, INGEST_GLOBAL_BURST, amount)
+        if wait > 0:
+            await refund_rates(taken)
+            return "global_rate", wait, []
+        taken.append(("global", INGEST_GLOBAL_RATE, INGEST_GLOBAL_BURST, amount))
+    return None, 0.0, taken
+
+_SHED_DETAILS = {
+    413: "Too many location updates in one request",
+    429: "Too many location updates",
+    503: "Ingest is overloaded, retry later",
+}
+
+async def _shed(send, status_code: int, reason: str, retry_after: Optional[float], fixes: int, detail: Optional[str] = None):
+    metrics.INGEST_SHED.inc(reason)
+    metrics.FIXES_SHED.inc(reason, amount=fixes)
+    body = json.dumps({"detail": detail or _SHED_DETAILS[status_code]}).encode()
+    headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+    ]
+    if retry_after is not None:
+        headers.append((b"retry-after", str(max(1, math.ceil(retry_after))).encode()))
+    await send({"type": "http.response.start", "status": status_code, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+def _gate_status():
+    return [(("in_flight",), gate.in_flight), (("queued",), len(gate.waiters))]
+
+metrics.REGISTRY.register(metrics.Gauge(
+    "ingest_requests",
+    "Ingest requests holding a slot (in_flight) or waiting for one (queued)",
+    ("state",),
+    callback=_gate_status
+))
+
+class AdmissionMiddleware:
+    """ASGI middleware applying rate limits and the ingest queue to INGEST_PATHS"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in INGEST_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        # Buffer the body to find the buses, then replay it to the route
+        length = dict(scope["headers"]).get(b"content-length", b"")
+        if INGEST_MAX_BODY_BYTES > 0 and length.isdigit() and int(length) > INGEST_MAX_BODY_BYTES:
+            await _shed(send, 413, "body_size", None, 0, "Request body too large")
+            return
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            chunks.append(message.get("body", b""))
+            size += len(chunks[-1])
+            if INGEST_MAX_BODY_BYTES > 0 and size > INGEST_MAX_BODY_BYTES:
+                await _shed(send, 413, "body_size", None, 0, "Request body too large")
+                return
+            more_body = message.get("more_body", False)
+        body = b"".join(chunks)
+
+        counts = fixes_per_bus(scope["path"], body)
+        fixes = sum(counts.values())
+        reason, retry_after, taken = await check_rates(counts)
+        if reason and reason.endswith("_burst"):
+            await _shed(send, 413, reason, None, fixes)
+            return
+        if reason:
+            await _shed(send, 429, reason, retry_after, fixes)
+            return
+
+        try:
+            reason = await gate.acquire()
+        except asyncio.CancelledError:
+            await asyncio.shield(refund_rates(taken))
+            raise
+        if reason:
+            # Never reached the writer; don't count it against the client's rate
+            await refund_rates(taken)
+            await _shed(send, 503, reason, INGEST_QUEUE_TIMEOUT_SECONDS, fixes)
+            return
+
+        replayed = False
+
+        async def replay():
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        try:
+            await self.app(scope, replay, send)
+        finally:
+            gate.release()
@@ -5,12 +5,13 @@ from passlib.context import CryptContext
 from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
-from database import get_db, Student, Admin
+from database import engine, get_db, get_read_db, SessionLocal, Student, Admin
 from models import TokenData
-from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES
+from config import SECRET_KEY, ALGORITHM, ACCESS_TOKEN_EXPIRE_MINUTES, DEFAULT_DISTRICT_ID
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -40,7 +41,7 @@ def authenticate_user(db: Session, username: str, password: str, user_type: str)
         return False
     return user
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_read_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -50,20 +51,32 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         user_type: str = payload.get("user_type")
+        # Tokens issued before districts existed belong to the default district
+        district_id: int = payload.get("district_id", DEFAULT_DISTRICT_ID)
         if username is None or user_type is None:
             raise credentials_exception
-        token_data = TokenData(username=username, user_type=user_type)
+        token_data = TokenData(username=username, user_type=user_type, district_id=district_id)
     except JWTError:
         raise credentials_exception
     
     if token_data.user_type == "student":
-        user = db.query(Student).filter(Student.username == token_data.username).first()
+        model = Student
     elif token_data.user_type == "admin":
-        user = db.query(Admin).filter(Admin.username == token_data.username).first()
+        model = Admin
     else:
         raise credentials_exception
     
-    if user is None:
+    user = db.query(model).filter(model.username == token_data.username).first()
+    if user is None and db.get_bind() is not engine:
+        # Created moments ago, possibly through another worker: the replica may lag
+        primary = SessionLocal()
+        try:
+            user = primary.query(model).filter(model.username == token_data.username).first()
+        finally:
+            primary.close()
+    
+    # Every query the user makes is scoped to the district in the token
+    if user is None or user.district_id != token_data.district_id:
         raise credentials_exception
     return user
 
@@ -81,4 +94,9 @@ async def get_current_student(current_user = Depends(get_current_user)):
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Not a student account"
         )
-    return current_user
\ No newline at end of file
+    return current_user
+async def get_optional_admin(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security), db: Session = Depends(get_db)):
+    """The signed-in admin, or None for requests without a token"""
+    if credentials is None:
+        return None
+    return await get_current_admin(await get_current_user(credentials, db))
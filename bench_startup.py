@@ -0,0 +1,94 @@
+"""
+Worker start-up benchmark
+
+Measures, each in a fresh interpreter:
+    import   - time to `import main` (the app module every worker loads)
+    no-db    - `import main` with DATABASE_URL pointing at an unreachable
+               path, which fails if anything touches the database at import
+    cold     - time from spawning uvicorn until /health answers
+
+    python bench_startup.py --runs 5
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+IMPORT_SNIPPET = (
+    "import time; started = time.perf_counter(); import main; "
+    "print(time.perf_counter() - started)"
+)
+
+def _run_python(code: str, env: dict) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [sys.executable, "-c", code], cwd=HERE, env=env, capture_output=True, text=True
+    )
+
+def measure_import(runs: int) -> list:
+    timings = []
+    for _ in range(runs):
+        result = _run_python(IMPORT_SNIPPET, dict(os.environ))
+        if result.returncode != 0:
+            raise SystemExit(result.stderr)
+        timings.append(float(result.stdout.strip().splitlines()[-1]))
+    return timings
+
+def check_no_db_io() -> bool:
+    env = dict(os.environ, DATABASE_URL="sqlite:////nonexistent-dir/school_bus.db")
+    return _run_python("import main", env).returncode == 0
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def measure_cold_start(runs: int, timeout: float = 30.0) -> list:
+    timings = []
+    for _ in range(runs):
+        port = _free_port()
+        started = time.perf_counter()
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+            cwd=HERE,
+        )
+        try:
+            while True:
+                if time.perf_counter() - started > timeout:
+                    raise SystemExit("server did not answer /health in time")
+                try:
+                    with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as response:
+                        if response.status == 200:
+                            break
+                except OSError:
+                    time.sleep(0.01)
+            timings.append(time.perf_counter() - started)
+        finally:
+            server.terminate()
+            server.wait()
+    return timings
+
+def _summary(name: str, timings: list) -> str:
+    return (
+        f"{name:<8} median={statistics.median(timings) * 1000:.1f}ms "
+        f"min={min(timings) * 1000:.1f}ms max={max(timings) * 1000:.1f}ms (n={len(timings)})"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark worker import and cold start")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--skip-cold", action="store_true", help="Only measure import")
+    args = parser.parse_args()
+
+    print(_summary("import", measure_import(args.runs)))
+    print(f"{'no-db':<8} {'ok - import does no database I/O' if check_no_db_io() else 'FAILED - import touches the database'}")
+    if not args.skip_cold:
+        print(_summary("cold", measure_cold_start(args.runs)))
+
+if __name__ == "__main__":
+    main()
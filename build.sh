@@ -9,3 +9,6 @@ export PATH=$CARGO_HOME/bin:$PATH
 # Upgrade pip and install dependencies
 python3 -m pip install --upgrade pip
 python3 -m pip install -r requirements.txt
+
+# Apply pending schema migrations; the app no longer creates tables on import
+python3 migrations.py upgrade
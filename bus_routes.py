@@ -1,8 +1,12 @@
 from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import JSONResponse
 from sqlalchemy.orm import Session
-from datetime import datetime
-from database import get_db, BusLocation, Bus
-from models import BusLocationCreate, BusLocationResponse
+from typing import List
+from database import get_db, get_read_db, BusLocation, Bus
+from models import BusLocationCreate, BusLocationBatch, BusLocationResponse
+from ingest import ingest_location, ingest_locations
+from sharding import LocationShards
+from health import readiness_report
 
 router = APIRouter(prefix="/bus", tags=["bus-hardware"])
 
@@ -11,46 +15,42 @@ def update_bus_location(
     location_data: BusLocationCreate,
     db: Session = Depends(get_db)
 ):
-    # Verify bus exists
-    bus = db.query(Bus).filter(Bus.id == location_data.bus_id).first()
-    if not bus:
-        raise HTTPException(status_code=404, detail="Bus not found")
-    
-    # Use provided timestamp or current time
-    timestamp = location_data.timestamp or datetime.utcnow()
-    
-    # Create new location record
-    db_location = BusLocation(
-        bus_id=location_data.bus_id,
-        latitude=location_data.latitude,
-        longitude=location_data.longitude,
-        timestamp=timestamp
-    )
-    
-    db.add(db_location)
-    db.commit()
-    db.refresh(db_location)
-    
-    return db_location
+    return ingest_location(db, location_data)
+
+@router.post("/update/batch", response_model=List[BusLocationResponse])
+def update_bus_locations_batch(
+    batch: BusLocationBatch,
+    db: Session = Depends(get_db)
+):
+    """Accept many GPS fixes in one request (gateways, simulators)"""
+    return ingest_locations(db, batch.locations)
 
 @router.get("/locations/{bus_id}", response_model=list[BusLocationResponse])
 def get_bus_location_history(
     bus_id: int,
     limit: int = 50,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     # Verify bus exists
     bus = db.query(Bus).filter(Bus.id == bus_id).first()
     if not bus:
         raise HTTPException(status_code=404, detail="Bus not found")
     
-    locations = db.query(BusLocation).filter(
-        BusLocation.bus_id == bus_id
-    ).order_by(BusLocation.timestamp.desc()).limit(limit).all()
+    # History lives in the bus's district shard when sharding is enabled
+    with LocationShards(db) as shards:
+        locations = shards.session(bus.district_id).query(BusLocation).filter(
+            BusLocation.bus_id == bus_id
+        ).order_by(BusLocation.timestamp.desc()).limit(limit).all()
     
     return locations
 
 @router.get("/health")
-def bus_api_health():
+async def bus_api_health():
     """Health check endpoint for bus hardware"""
+    report = await readiness_report()
+    if report["status"] != "ready":
+        return JSONResponse(
+            {"status": "unavailable", "message": "Bus API cannot store locations"},
+            status_code=503
+        )
     return {"status": "ok", "message": "Bus API is running"}
\ No newline at end of file
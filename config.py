@@ -10,7 +10,51 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 # Database Configuration
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./school_bus.db")
+READ_DATABASE_URLS = [url.strip() for url in os.getenv("READ_DATABASE_URL", "").split(",") if url.strip()]  # Comma-separated replicas
+REPLICA_LAG_SECONDS = float(os.getenv("REPLICA_LAG_SECONDS", "2"))  # Read from the primary this long after a write
+
+# Districts
+DEFAULT_DISTRICT_ID = int(os.getenv("DEFAULT_DISTRICT_ID", "1"))  # District of existing rows and unscoped GUI forms
+LOCATION_SHARD_URL = os.getenv("LOCATION_SHARD_URL", "")  # e.g. sqlite:///./locations_{district_id}.db; empty keeps history in DATABASE_URL
 
 # Bus Configuration
 AVERAGE_BUS_SPEED_KMH = 30  # Average bus speed in km/h
-APPROACHING_DISTANCE_KM = 1.0  # Distance in km to consider bus "approaching"
\ No newline at end of file
+APPROACHING_DISTANCE_KM = 1.0  # Distance in km to consider bus "approaching"
+SEQ_RESTART_GAP = int(os.getenv("SEQ_RESTART_GAP", "10000"))  # A seq this far below the newest one means the tracker restarted
+
+# Ingest Admission Control (0 disables a limit)
+INGEST_MAX_BATCH = int(os.getenv("INGEST_MAX_BATCH", "500"))  # Fixes accepted in one /bus/update/batch request
+INGEST_MAX_BODY_BYTES = int(os.getenv("INGEST_MAX_BODY_BYTES", "262144"))  # Larger ingest bodies are refused before parsing
+INGEST_BUS_RATE = float(os.getenv("INGEST_BUS_RATE", "2"))  # Sustained fixes per second per bus
+INGEST_BUS_BURST = float(os.getenv("INGEST_BUS_BURST", "20"))
+INGEST_GLOBAL_RATE = float(os.getenv("INGEST_GLOBAL_RATE", "500"))  # Sustained fixes per second for the fleet
+INGEST_GLOBAL_BURST = float(os.getenv("INGEST_GLOBAL_BURST", "1000"))
+INGEST_MAX_IN_FLIGHT = int(os.getenv("INGEST_MAX_IN_FLIGHT", "8"))  # Keep below threadpool and DB pool size
+INGEST_MAX_QUEUE = int(os.getenv("INGEST_MAX_QUEUE", "100"))  # Ingest requests allowed to wait for a slot
+INGEST_QUEUE_TIMEOUT_SECONDS = float(os.getenv("INGEST_QUEUE_TIMEOUT_SECONDS", "2"))
+ADMISSION_REDIS_URL = os.getenv("ADMISSION_REDIS_URL", "")  # Share rate limits between workers when set
+
+# Health Check Configuration
+DB_PROBE_TIMEOUT_SECONDS = float(os.getenv("DB_PROBE_TIMEOUT_SECONDS", "1.0"))
+READINESS_CACHE_SECONDS = float(os.getenv("READINESS_CACHE_SECONDS", "1.0"))  # Reuse probe results for this long
+STALE_BUS_SECONDS = int(os.getenv("STALE_BUS_SECONDS", "300"))  # Bus is stale without a fix for this long
+FLEET_REFRESH_SECONDS = int(os.getenv("FLEET_REFRESH_SECONDS", "30"))  # How often to reload bus list and last fixes
+
+# Profiling Configuration
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"  # Profile every request
+PROFILING_MODE = os.getenv("PROFILING_MODE", "sample")  # "sample" (all threads) or "cprofile" (event loop thread)
+PROFILING_THRESHOLD_MS = float(os.getenv("PROFILING_THRESHOLD_MS", "500"))  # Keep profiles slower than this
+PROFILING_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILING_SAMPLE_INTERVAL_MS", "5"))
+PROFILING_KEEP = int(os.getenv("PROFILING_KEEP", "20"))  # Number of profiles kept in memory
+PROFILING_TOKEN_EXPIRE_MINUTES = 60  # Lifetime of signed X-Profile header values
+
+# Station Status Snapshots
+SNAPSHOT_MAX_AGE_SECONDS = float(os.getenv("SNAPSHOT_MAX_AGE_SECONDS", "5"))  # Rebuild cached snapshots older than this
+SNAPSHOT_PERSIST = os.getenv("SNAPSHOT_PERSIST", "false").lower() == "true"  # Share snapshots between workers via the DB
+
+# Geofence Alerts
+ARRIVED_DISTANCE_KM = float(os.getenv("ARRIVED_DISTANCE_KM", "0.1"))  # Distance in km to consider bus "arrived"
+GEOFENCE_LOOKAHEAD_STOPS = int(os.getenv("GEOFENCE_LOOKAHEAD_STOPS", "3"))  # Stops ahead of the bus checked per fix
+GEOFENCE_ROUTE_MAX_AGE_SECONDS = float(os.getenv("GEOFENCE_ROUTE_MAX_AGE_SECONDS", "30"))  # Reload cached stops and riders older than this
+TRIP_GAP_MINUTES = int(os.getenv("TRIP_GAP_MINUTES", "30"))  # A longer silence starts a new trip
+GEOFENCE_WEBHOOK_URL = os.getenv("GEOFENCE_WEBHOOK_URL", "")  # POST alerts here when set
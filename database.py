@@ -1,13 +1,78 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Boolean
+import random
+import time
+from sqlalchemy import create_engine, event, Column, Integer, BigInteger, String, Float, DateTime, ForeignKey, Boolean, Text, UniqueConstraint, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
-from config import DATABASE_URL
+from config import DATABASE_URL, READ_DATABASE_URLS, REPLICA_LAG_SECONDS, DEFAULT_DISTRICT_ID
+import metrics
+import profiling
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {})
+# Query counting and timing for /metrics and request profiles
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_start_time"].pop()
+    duration = time.perf_counter() - started
+    metrics.record_query(duration)
+    profiling.record_query(statement, duration)
+
+def create_instrumented_engine(url: str):
+    """Engine whose queries are counted in /metrics and request profiles"""
+    new_engine = create_engine(url, connect_args={"check_same_thread": False} if "sqlite" in url else {})
+    event.listen(new_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(new_engine, "after_cursor_execute", _after_cursor_execute)
+    return new_engine
+
+# Primary: every write, plus reads that must see them
+engine = create_instrumented_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Read replicas; without READ_DATABASE_URL all reads go to the primary
+read_engines = [create_instrumented_engine(url) for url in READ_DATABASE_URLS]
+ReadSessions = [sessionmaker(autocommit=False, autoflush=False, bind=e) for e in read_engines]
 Base = declarative_base()
 
+# Replica lag: remember when each table was last committed on the primary.
+# Live positions are served from snapshots built on the primary at ingest,
+# so the GPS tables are not tracked - they are written constantly and
+# would otherwise keep every read on the primary.
+LAG_EXEMPT_TABLES = {"bus_locations", "bus_status_snapshots", "student_alerts", "bus_trips"}
+_last_write: dict = {}
+
+def _mark_tables(session, tables):
+    session.info.setdefault("written_tables", set()).update(
+        t for t in tables if t not in LAG_EXEMPT_TABLES
+    )
+
+@event.listens_for(SessionLocal, "after_flush")
+def _after_flush(session, flush_context):
+    _mark_tables(session, {
+        obj.__table__.name for obj in list(session.new) + list(session.dirty) + list(session.deleted)
+    })
+
+@event.listens_for(SessionLocal, "do_orm_execute")
+def _do_orm_execute(orm_execute_state):
+    # Bulk query.update()/delete() and insert() bypass the flush
+    if orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert:
+        _mark_tables(orm_execute_state.session, {orm_execute_state.statement.table.name})
+
+@event.listens_for(SessionLocal, "after_commit")
+def _after_commit(session):
+    now = time.monotonic()
+    for table in session.info.pop("written_tables", ()):
+        _last_write[table] = now
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _after_rollback(session):
+    session.info.pop("written_tables", None)
+
+def replica_is_fresh() -> bool:
+    """False while a tracked table was committed in this worker less than REPLICA_LAG_SECONDS ago"""
+    cutoff = time.monotonic() - REPLICA_LAG_SECONDS
+    return all(written < cutoff for written in _last_write.values())
+
 class Student(Base):
     __tablename__ = "students"
     
@@ -15,8 +80,9 @@ class Student(Base):
     name = Column(String, nullable=False)
     username = Column(String, unique=True, index=True, nullable=False)
     password_hash = Column(String, nullable=False)
-    assigned_bus_id = Column(Integer, ForeignKey("buses.id"), nullable=True)
-    assigned_station_id = Column(Integer, ForeignKey("stations.id"), nullable=True)
+    assigned_bus_id = Column(Integer, ForeignKey("buses.id"), nullable=True, index=True)
+    assigned_station_id = Column(Integer, ForeignKey("stations.id"), nullable=True, index=True)
+    district_id = Column(Integer, nullable=False, default=DEFAULT_DISTRICT_ID, index=True)
     
     bus = relationship("Bus", back_populates="students")
     station = relationship("Station", back_populates="students")
@@ -28,6 +94,7 @@ class Bus(Base):
     bus_number = Column(String, unique=True, nullable=False)
     driver_name = Column(String, nullable=False)
     driver_phone = Column(String, nullable=False)
+    district_id = Column(Integer, nullable=False, default=DEFAULT_DISTRICT_ID, index=True)
     
     students = relationship("Student", back_populates="bus")
     stations = relationship("Station", back_populates="bus")
@@ -35,6 +102,9 @@ class Bus(Base):
 
 class Station(Base):
     __tablename__ = "stations"
+    __table_args__ = (
+        Index("ix_stations_bus_id_order_number", "bus_id", "order_number"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String, nullable=False)
@@ -42,21 +112,65 @@ class Station(Base):
     longitude = Column(Float, nullable=False)
     bus_id = Column(Integer, ForeignKey("buses.id"), nullable=False)
     order_number = Column(Integer, nullable=False)
+    district_id = Column(Integer, nullable=False, default=DEFAULT_DISTRICT_ID, index=True)
     
     bus = relationship("Bus", back_populates="stations")
     students = relationship("Student", back_populates="station")
 
 class BusLocation(Base):
     __tablename__ = "bus_locations"
+    __table_args__ = (
+        # Retried fixes from the same tracker collapse onto one row
+        UniqueConstraint("bus_id", "device_id", "seq", name="uq_bus_locations_device_seq"),
+        Index("ix_bus_locations_bus_id_timestamp", "bus_id", "timestamp"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     bus_id = Column(Integer, ForeignKey("buses.id"), nullable=False)
     latitude = Column(Float, nullable=False)
     longitude = Column(Float, nullable=False)
     timestamp = Column(DateTime, default=datetime.utcnow)
+    device_id = Column(String, nullable=True)
+    seq = Column(BigInteger, nullable=True)
+    out_of_order = Column(Boolean, default=False, nullable=False)  # Late fix, history only
+    district_id = Column(Integer, nullable=False, default=DEFAULT_DISTRICT_ID, index=True)
     
     bus = relationship("Bus", back_populates="locations")
 
+class BusStatusSnapshot(Base):
+    __tablename__ = "bus_status_snapshots"
+    
+    bus_id = Column(Integer, ForeignKey("buses.id"), primary_key=True)
+    location_id = Column(Integer, nullable=True)
+    payload = Column(Text, nullable=False)  # JSON encoded snapshot, see snapshots.py
+    updated_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+class BusTrip(Base):
+    __tablename__ = "bus_trips"
+    
+    bus_id = Column(Integer, ForeignKey("buses.id"), primary_key=True)
+    trip_key = Column(String, nullable=False)  # Current trip, see geofence.py
+    started_at = Column(DateTime, nullable=False)
+    last_fix_at = Column(DateTime, nullable=False)
+    reached_end = Column(Boolean, default=False, nullable=False)  # Bus has been at its last stop this trip
+
+class StudentAlert(Base):
+    __tablename__ = "student_alerts"
+    __table_args__ = (
+        # One alert of each kind per student, stop and trip, whichever worker raises it
+        UniqueConstraint("student_id", "station_id", "kind", "trip_key", name="uq_student_alerts_trip"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    student_id = Column(Integer, ForeignKey("students.id"), nullable=False, index=True)
+    bus_id = Column(Integer, ForeignKey("buses.id"), nullable=False)
+    station_id = Column(Integer, ForeignKey("stations.id"), nullable=False)
+    kind = Column(String, nullable=False)  # "approaching" or "arrived"
+    distance_km = Column(Float, nullable=False)
+    eta_minutes = Column(Integer, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    trip_key = Column(String, nullable=True)
+
 class Admin(Base):
     __tablename__ = "admins"
     
@@ -64,6 +178,7 @@ class Admin(Base):
     username = Column(String, unique=True, index=True, nullable=False)
     password_hash = Column(String, nullable=False)
     is_admin = Column(Boolean, default=True)
+    district_id = Column(Integer, nullable=False, default=DEFAULT_DISTRICT_ID, index=True)
 
 # Database dependency
 def get_db():
@@ -73,5 +188,17 @@ def get_db():
     finally:
         db.close()
 
-# Create all tables
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+def get_read_db():
+    """Session on a read replica, or on the primary when none is configured or it may lag a recent write"""
+    if ReadSessions and replica_is_fresh():
+        metrics.READ_SESSIONS.inc("replica")
+        db = random.choice(ReadSessions)()
+    else:
+        metrics.READ_SESSIONS.inc("primary")
+        db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+# Tables and indexes are created by migrations.py, never at import
@@ -0,0 +1,314 @@
+"""
+Ingest-side geofence alerts ("bus approaching your stop")
+
+Each live fix is checked against the few stops around the bus's position
+on its route - the stop it is nearest to plus GEOFENCE_LOOKAHEAD_STOPS
+ahead - rather than against every student. When none of those stops is
+within APPROACHING_DISTANCE_KM the bus is located on the whole route
+again. Students are indexed by assigned station, so an alert only touches
+the riders of the stop that fired. Each worker reloads a bus's stops and
+riders once they are older than GEOFENCE_ROUTE_MAX_AGE_SECONDS, so route
+and assignment changes made through another worker reach it too.
+
+Every (student, stop, kind) fires once per trip. The current trip of
+each bus is kept in `bus_trips`, so every worker agrees on it, and
+`student_alerts` is unique per (student, stop, kind, trip): an alert
+another worker (or this one before a restart) already stored is not
+delivered again. A new trip starts after TRIP_GAP_MINUTES without fixes,
+or when a bus that has been at its last stop is back in the first half
+of its route.
+
+Alerts are stored in `student_alerts`, the in-app feed read through
+GET /student/alerts, and then go to every configured notifier, such as a
+JSON webhook when GEOFENCE_WEBHOOK_URL is set.
+"""
+import json
+import queue
+from abc import ABC, abstractmethod
+import threading
+import time
+import urllib.request
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from database import SessionLocal, Station, Student, StudentAlert, BusLocation, BusTrip
+from utils import haversine_distance, calculate_eta_minutes
+from config import (
+    APPROACHING_DISTANCE_KM, ARRIVED_DISTANCE_KM, GEOFENCE_LOOKAHEAD_STOPS,
+    GEOFENCE_ROUTE_MAX_AGE_SECONDS, TRIP_GAP_MINUTES, GEOFENCE_WEBHOOK_URL
+)
+import metrics
+
+# bus_trips.last_fix_at is only rewritten once it is this far behind
+TRIP_TOUCH_SECONDS = 60
+
+@dataclass
+class RouteIndex:
+    stations: List[Tuple[int, str, float, float]]  # (id, name, lat, lon) in route order
+    riders: Dict[int, List[int]]  # station_id -> student ids
+    loaded_at: float = field(default_factory=time.monotonic)
+
+@dataclass
+class TripState:
+    """What this worker knows of a bus's current trip"""
+    key: str
+    route_idx: Optional[int] = None
+    fired: Set[Tuple[int, str]] = field(default_factory=set)  # Stored this trip, skip without a query
+
+_routes: Dict[int, RouteIndex] = {}
+_trips: Dict[int, TripState] = {}
+
+def _load_route(db: Session, bus_id: int) -> RouteIndex:
+    route = _routes.get(bus_id)
+    if route is not None and time.monotonic() - route.loaded_at >= GEOFENCE_ROUTE_MAX_AGE_SECONDS:
+        # Stations or assignments may have changed through another worker
+        invalidate([bus_id])
+        route = None
+    if route is None:
+        stations = db.query(Station).filter(Station.bus_id == bus_id).order_by(Station.order_number).all()
+        riders: Dict[int, List[int]] = {}
+        rows = db.query(Student.id, Student.assigned_station_id).filter(
+            Student.assigned_bus_id == bus_id,
+            Student.assigned_station_id.isnot(None)
+        ).all()
+        for student_id, station_id in rows:
+            riders.setdefault(station_id, []).append(student_id)
+        route = RouteIndex(
+            stations=[(s.id, s.name, s.latitude, s.longitude) for s in stations],
+            riders=riders
+        )
+        _routes[bus_id] = route
+    return route
+
+def invalidate(bus_ids: Iterable[int]):
+    """Forget cached routes and riders after stations or assignments change"""
+    for bus_id in bus_ids:
+        _routes.pop(bus_id, None)
+        trip = _trips.get(bus_id)
+        if trip:
+            trip.route_idx = None
+
+def _distance(route: RouteIndex, i: int, lat: float, lon: float) -> float:
+    return haversine_distance(lat, lon, route.stations[i][2], route.stations[i][3])
+
+def _nearest_index(route: RouteIndex, lat: float, lon: float, start: int, stop: int) -> int:
+    return min(range(start, stop), key=lambda i: _distance(route, i, lat, lon))
+
+def _locate(route: RouteIndex, trip: TripState, lat: float, lon: float) -> int:
+    """Index of the stop the bus is nearest to"""
+    count = len(route.stations)
+    if trip.route_idx is not None:
+        # Look around where the bus was
+        start = max(trip.route_idx - 1, 0)
+        stop = min(trip.route_idx + GEOFENCE_LOOKAHEAD_STOPS + 1, count)
+        index = _nearest_index(route, lat, lon, start, stop)
+        if _distance(route, index, lat, lon) <= APPROACHING_DISTANCE_KM:
+            return index
+    # First fix this worker sees, or the bus left its window: search the whole route
+    return _nearest_index(route, lat, lon, 0, count)
+
+def _start_trip(db: Session, row: Optional[BusTrip], bus_id: int, timestamp: datetime) -> BusTrip:
+    """Record a new trip, or adopt the one another worker started at the same time"""
+    values = {"trip_key": timestamp.isoformat(), "started_at": timestamp, "last_fix_at": timestamp, "reached_end": False}
+    try:
+        if row is None:
+            db.add(BusTrip(bus_id=bus_id, **values))
+            started = True
+        else:
+            # Only replace the trip we saw; losing the race means it has been replaced already
+            started = db.query(BusTrip).filter(
+                BusTrip.bus_id == bus_id, BusTrip.trip_key == row.trip_key
+            ).update(values, synchronize_session=False) == 1
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        started = False
+    row = db.get(BusTrip, bus_id)
+    if started:
+        metrics.TRIPS_STARTED.inc()
+    return row
+
+def _current_trip(db: Session, route: RouteIndex, location: BusLocation) -> Tuple[TripState, int]:
+    """The bus's trip after this fix and the stop it is nearest to"""
+    bus_id = location.bus_id
+    row = db.get(BusTrip, bus_id)
+    trip = _trips.get(bus_id)
+    if row is not None and (trip is None or trip.key != row.trip_key):
+        trip = _trips[bus_id] = TripState(key=row.trip_key)
+    elif trip is None:
+        trip = TripState(key="")
+
+    index = _locate(route, trip, location.latitude, location.longitude)
+    count = len(route.stations)
+    new_trip = (
+        row is None
+        or location.timestamp - row.last_fix_at > timedelta(minutes=TRIP_GAP_MINUTES)
+        # Back at the start after the end of the route: the next lap
+        or (row.reached_end and index < count // 2)
+    )
+    if new_trip:
+        row = _start_trip(db, row, bus_id, location.timestamp)
+        if trip.key != row.trip_key:
+            trip = _trips[bus_id] = TripState(key=row.trip_key)
+    else:
+        reached_end = row.reached_end or index == count - 1
+        if reached_end != row.reached_end or location.timestamp - row.last_fix_at > timedelta(seconds=TRIP_TOUCH_SECONDS):
+            row.reached_end = reached_end
+            row.last_fix_at = max(row.last_fix_at, location.timestamp)
+            db.commit()
+    trip.route_idx = index
+    return trip, index
+
+def check_fix(db: Session, location: BusLocation) -> List[dict]:
+    """Alerts raised by one live fix; cost is O(stops near the bus)"""
+    bus_id = location.bus_id
+    route = _load_route(db, bus_id)
+    if not route.stations:
+        return []
+
+    trip, index = _current_trip(db, route, location)
+    alerts = []
+    stop = min(index + GEOFENCE_LOOKAHEAD_STOPS + 1, len(route.stations))
+    for station_id, name, lat, lon in route.stations[index:stop]:
+        riders = route.riders.get(station_id)
+        if not riders:
+            continue
+        distance = haversine_distance(location.latitude, location.longitude, lat, lon)
+        if distance <= ARRIVED_DISTANCE_KM:
+            kind = "arrived"
+        elif distance <= APPROACHING_DISTANCE_KM:
+            kind = "approaching"
+        else:
+            continue
+        if (station_id, kind) in trip.fired:
+            continue
+        trip.fired.add((station_id, kind))
+        # Arriving implies approaching; don't send that one afterwards
+        trip.fired.add((station_id, "approaching"))
+        for student_id in riders:
+            alerts.append({
+                "student_id": student_id,
+                "bus_id": bus_id,
+                "station_id": station_id,
+                "station_name": name,
+                "kind": kind,
+                "distance_km": round(distance, 3),
+                "eta_minutes": calculate_eta_minutes(distance),
+                "created_at": location.timestamp,
+                "trip_key": trip.key,
+            })
+    return alerts
+
+def _alert_key(alert: dict) -> Tuple[int, int, str]:
+    return (alert["student_id"], alert["station_id"], alert["kind"])
+
+def store_alerts(alerts: List[dict]) -> List[dict]:
+    """
+    Add alerts to the in-app feed (student_alerts)
+    Returns those not stored before for their trip; only they are delivered
+    """
+    db = SessionLocal()
+    try:
+        trip_key = alerts[0]["trip_key"]
+        stored = set(db.query(StudentAlert.student_id, StudentAlert.station_id, StudentAlert.kind).filter(
+            StudentAlert.trip_key == trip_key,
+            StudentAlert.station_id.in_({alert["station_id"] for alert in alerts})
+        ).all())
+        # An arrival stored by another worker also covers approaching
+        stored |= {(student_id, station_id, "approaching") for student_id, station_id, kind in stored if kind == "arrived"}
+        alerts = [alert for alert in alerts if _alert_key(alert) not in stored]
+        rows = [(alert, _alert_row(alert)) for alert in alerts]
+        db.add_all(row for _, row in rows)
+        try:
+            db.commit()
+            return alerts
+        except IntegrityError:
+            # Another worker stored some of them meanwhile; keep the rest one by one
+            db.rollback()
+        new = []
+        for alert, _ in rows:
+            db.add(_alert_row(alert))
+            try:
+                db.commit()
+                new.append(alert)
+            except IntegrityError:
+                db.rollback()
+        return new
+    finally:
+        db.close()
+
+def _alert_row(alert: dict) -> StudentAlert:
+    return StudentAlert(
+        student_id=alert["student_id"],
+        bus_id=alert["bus_id"],
+        station_id=alert["station_id"],
+        kind=alert["kind"],
+        distance_km=alert["distance_km"],
+        eta_minutes=alert["eta_minutes"],
+        created_at=alert["created_at"],
+        trip_key=alert["trip_key"]
+    )
+
+class Notifier(ABC):
+    @abstractmethod
+    def notify(self, alerts: List[dict]):
+        """Deliver newly stored alerts; must not block ingest"""
+
+class WebhookNotifier(Notifier):
+    """POSTs alerts as JSON from a background thread so ingest never waits"""
+
+    def __init__(self, url: str, timeout: float = 5.0, max_pending: int = 1000):
+        self.url = url
+        self.timeout = timeout
+        self.pending: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self._run, name="geofence-webhook", daemon=True)
+        self.thread.start()
+
+    def notify(self, alerts: List[dict]):
+        try:
+            self.pending.put_nowait(alerts)
+        except queue.Full:
+            metrics.ALERTS_DROPPED.inc(amount=len(alerts))
+
+    def _run(self):
+        while True:
+            alerts = self.pending.get()
+            body = json.dumps({"alerts": alerts}, default=str).encode()
+            request = urllib.request.Request(
+                self.url, data=body, headers={"Content-Type": "application/json"}, method="POST"
+            )
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    response.read()
+            except Exception:
+                metrics.ALERTS_DROPPED.inc(amount=len(alerts))
+
+notifiers: List[Notifier] = []
+if GEOFENCE_WEBHOOK_URL:
+    notifiers.append(WebhookNotifier(GEOFENCE_WEBHOOK_URL))
+
+def process_fix(db: Session, location: BusLocation):
+    """Check a live fix and deliver any alerts (called from ingest)"""
+    alerts: List[dict] = []
+    try:
+        alerts = check_fix(db, location)
+        if alerts:
+            alerts = store_alerts(alerts)
+    except Exception:
+        # The fix is already stored; failing alerts must not fail ingest.
+        # Roll back so the caller can keep using its session; a failed
+        # check counts once, since its alerts are unknown
+        db.rollback()
+        metrics.ALERTS_DROPPED.inc(amount=max(len(alerts), 1))
+        return
+    if not alerts:
+        return
+    metrics.ALERTS_SENT.inc(amount=len(alerts))
+    for notifier in notifiers:
+        try:
+            notifier.notify(alerts)
+        except Exception:
+            # The fix is already stored; a failing notifier must not fail ingest
+            metrics.ALERTS_DROPPED.inc(amount=len(alerts))
@@ -0,0 +1,171 @@
+"""
+Readiness checks for load balancer probes
+
+The report is rebuilt at most once per READINESS_CACHE_SECONDS, so any
+number of probes costs one `SELECT 1` per interval. Stale-bus detection
+reads last-fix times kept in memory; the bus list and per-bus last fix
+are reloaded from the database every FLEET_REFRESH_SECONDS regardless of
+probe rate, which keeps other workers' ingest visible. Each bus's last
+fix is one seek on ix_bus_locations_bus_id_timestamp, so the refresh
+does not grow with location history. A report waits at most
+DB_PROBE_TIMEOUT_SECONDS for the reload; a slower one finishes in the
+background while the previous fleet data is served.
+"""
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from sqlalchemy import select, text
+from database import engine, SessionLocal, Bus, BusLocation
+from sharding import LocationShards, sharding_enabled
+from config import (
+    DB_PROBE_TIMEOUT_SECONDS, READINESS_CACHE_SECONDS,
+    STALE_BUS_SECONDS, FLEET_REFRESH_SECONDS
+)
+import metrics
+
+_report: Optional[dict] = None
+_report_time = 0.0
+_report_lock = asyncio.Lock()
+_probe_in_flight = False
+
+_fleet_ids: List[int] = []
+_fleet_districts: Dict[int, int] = {}
+_fleet_last_fix: Dict[int, datetime] = {}
+_fleet_loaded_at = 0.0
+_fleet_reload: Optional[asyncio.Future] = None
+
+def _probe_db() -> float:
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        conn.execute(text("SELECT 1"))
+    return time.perf_counter() - started
+
+def pool_status() -> dict:
+    """Connection pool usage; saturation is None for pools without a fixed size"""
+    pool = engine.pool
+    if not hasattr(pool, "checkedout") or not hasattr(pool, "size"):
+        return {"class": type(pool).__name__, "saturation": None}
+    capacity = pool.size() + max(getattr(pool, "_max_overflow", 0), 0)
+    checked_out = pool.checkedout()
+    return {
+        "class": type(pool).__name__,
+        "size": pool.size(),
+        "checked_out": checked_out,
+        "overflow": pool.overflow(),
+        "capacity": capacity,
+        "saturation": round(checked_out / capacity, 3) if capacity else None,
+    }
+
+def _last_fix_query(bus_id):
+    """Newest fix time of one bus, read from the end of its index range"""
+    return select(BusLocation.timestamp).where(
+        BusLocation.bus_id == bus_id
+    ).order_by(BusLocation.timestamp.desc()).limit(1)
+
+def _load_fleet():
+    db = SessionLocal()
+    try:
+        if sharding_enabled():
+            districts = dict(db.query(Bus.id, Bus.district_id).all())
+            # Location history is in each district's database
+            last_fixes = {}
+            with LocationShards(db) as shards:
+                for bus_id, district_id in districts.items():
+                    last_fixes[bus_id] = shards.session(district_id).execute(_last_fix_query(bus_id)).scalar()
+        else:
+            rows = db.query(Bus.id, Bus.district_id, _last_fix_query(Bus.id).scalar_subquery()).all()
+            districts = {bus_id: district_id for bus_id, district_id, _ in rows}
+            last_fixes = {bus_id: last_fix for bus_id, _, last_fix in rows}
+    finally:
+        db.close()
+    return districts, {bus_id: last_fix for bus_id, last_fix in last_fixes.items() if last_fix}
+
+def _store_fleet(reload: asyncio.Future):
+    global _fleet_ids, _fleet_districts, _fleet_last_fix, _fleet_reload
+    _fleet_reload = None
+    if reload.cancelled() or reload.exception() is not None:
+        # Keep serving the previous fleet data
+        return
+    _fleet_districts, _fleet_last_fix = reload.result()
+    _fleet_ids = list(_fleet_districts)
+
+async def _refresh_fleet():
+    """Reload the fleet when due, waiting at most DB_PROBE_TIMEOUT_SECONDS for it"""
+    global _fleet_loaded_at, _fleet_reload
+    if _fleet_reload is None:
+        if time.monotonic() - _fleet_loaded_at < FLEET_REFRESH_SECONDS:
+            return
+        _fleet_loaded_at = time.monotonic()
+        _fleet_reload = asyncio.ensure_future(asyncio.to_thread(_load_fleet))
+        _fleet_reload.add_done_callback(_store_fleet)
+    # A slow reload keeps running in the background; don't hold the report lock for it
+    await asyncio.wait([_fleet_reload], timeout=DB_PROBE_TIMEOUT_SECONDS)
+
+def stale_buses(now: Optional[datetime] = None) -> List[dict]:
+    """Buses without a fix inside STALE_BUS_SECONDS, from cached data only"""
+    now = now or datetime.utcnow()
+    cutoff = now - timedelta(seconds=STALE_BUS_SECONDS)
+    local_fixes = metrics.last_fix_times()
+    stale = []
+    for bus_id in _fleet_ids:
+        candidates = [t for t in (_fleet_last_fix.get(bus_id), local_fixes.get(bus_id)) if t]
+        last_fix = max(candidates) if candidates else None
+        if last_fix is None or last_fix < cutoff:
+            stale.append({
+                "bus_id": bus_id,
+                "district_id": _fleet_districts.get(bus_id),
+                "last_fix": last_fix.isoformat() if last_fix else None,
+                "age_seconds": int((now - last_fix).total_seconds()) if last_fix else None,
+            })
+    return stale
+
+async def _build_report() -> dict:
+    global _probe_in_flight
+    report = {"status": "ready", "checked_at": datetime.utcnow().isoformat()}
+
+    if _probe_in_flight:
+        # A previous probe is still stuck on the database; don't pile up threads
+        report["database"] = {"ok": False, "error": "previous probe still pending"}
+    else:
+        _probe_in_flight = True
+        probe = asyncio.ensure_future(asyncio.to_thread(_probe_db))
+        probe.add_done_callback(_clear_in_flight)
+        try:
+            latency = await asyncio.wait_for(asyncio.shield(probe), DB_PROBE_TIMEOUT_SECONDS)
+            report["database"] = {"ok": True, "latency_ms": round(latency * 1000, 2)}
+        except asyncio.TimeoutError:
+            report["database"] = {"ok": False, "error": f"timed out after {DB_PROBE_TIMEOUT_SECONDS}s"}
+        except Exception as exc:
+            report["database"] = {"ok": False, "error": str(exc)}
+
+    report["pool"] = pool_status()
+
+    if report["database"]["ok"]:
+        await _refresh_fleet()
+    stale = stale_buses()
+    report["buses"] = {
+        "total": len(_fleet_ids),
+        "stale_after_seconds": STALE_BUS_SECONDS,
+        "stale": stale,
+    }
+
+    saturation = report["pool"].get("saturation")
+    if not report["database"]["ok"] or (saturation is not None and saturation >= 1.0):
+        report["status"] = "not_ready"
+    return report
+
+def _clear_in_flight(_future):
+    global _probe_in_flight
+    _probe_in_flight = False
+
+async def readiness_report() -> dict:
+    """Return the cached readiness report, rebuilding it when expired"""
+    global _report, _report_time
+    if _report is not None and time.monotonic() - _report_time < READINESS_CACHE_SECONDS:
+        return _report
+    async with _report_lock:
+        if _report is None or time.monotonic() - _report_time >= READINESS_CACHE_SECONDS:
+            _report = await _build_report()
+            _report_time = time.monotonic()
+    return _report
@@ -0,0 +1,269 @@
+"""
+GPS fix ingest shared by /bus/update, /bus/update/batch and the simulator
+
+Fixes may carry a per-device sequence number (`device_id` + `seq`).
+Each worker keeps a high-water mark per bus and device, so new fixes are
+stored without a lookup. A fix numbered at or below the highest stored
+seq is looked up: when the stored row has the same coordinates (and
+timestamp, if the tracker sends one) it is a retry and is answered with
+that row without writing. Fixes below the mark are stored as history
+with `out_of_order` set and never replace the live position. The unique
+constraint on (bus_id, device_id, seq) catches retries that race across
+workers.
+
+A tracker that reboots counts from the start again. A reused seq whose
+stored row differs, a seq more than SEQ_RESTART_GAP below the mark, or a
+lower seq with a newer timestamp resets the mark, so the fix is live
+again. The old row keeps its place in history with its seq cleared.
+
+Each district's fixes are written to its own location database when
+LOCATION_SHARD_URL is set (see sharding.py).
+"""
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
+from fastapi import HTTPException
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from database import Bus, BusLocation
+from models import BusLocationCreate
+from config import SEQ_RESTART_GAP
+import geofence
+import metrics
+import sharding
+import snapshots
+
+# device_id stored for sequenced fixes that don't name a device
+DEFAULT_DEVICE_ID = "default"
+
+@dataclass
+class SeqMark:
+    seq: int  # Live position: highest seq since the tracker last restarted, -1 when none
+    timestamp: Optional[datetime]  # Timestamp of that fix
+    ceiling: int  # Highest seq stored; fixes up to it may be retries
+
+# (bus_id, device_id) -> mark
+_high_water: Dict[Tuple[int, str], SeqMark] = {}
+
+def _device_key(location: BusLocationCreate) -> Tuple[int, str]:
+    return (location.bus_id, location.device_id or DEFAULT_DEVICE_ID)
+
+def _high_water_mark(db: Session, key: Tuple[int, str]) -> SeqMark:
+    """`db` is the session on the bus's location database"""
+    if key not in _high_water:
+        # Seed from the database the first time this worker sees the device
+        row = db.query(BusLocation.seq, BusLocation.timestamp).filter(
+            BusLocation.bus_id == key[0],
+            BusLocation.device_id == key[1],
+            BusLocation.seq.isnot(None)
+        ).order_by(BusLocation.seq.desc()).first()
+        mark = SeqMark(row.seq, row.timestamp, row.seq) if row else SeqMark(-1, None, -1)
+        _high_water.setdefault(key, mark)
+    return _high_water[key]
+
+def _stored_fix(db: Session, bus_id: int, device_id: str, seq: int) -> Optional[BusLocation]:
+    return db.query(BusLocation).filter(
+        BusLocation.bus_id == bus_id,
+        BusLocation.device_id == device_id,
+        BusLocation.seq == seq
+    ).first()
+
+def _same_fix(stored: BusLocation, location: BusLocationCreate) -> bool:
+    """A retry repeats the coordinates, and the timestamp when the tracker sends one"""
+    if stored.latitude != location.latitude or stored.longitude != location.longitude:
+        return False
+    return location.timestamp is None or stored.timestamp == location.timestamp
+
+def _is_restart(mark: SeqMark, location: BusLocationCreate) -> bool:
+    """A seq far below the mark, or a lower one with a newer timestamp, means the tracker counts from the start again"""
+    if location.seq > mark.seq:
+        return False
+    if mark.seq - location.seq > SEQ_RESTART_GAP:
+        return True
+    return location.timestamp is not None and mark.timestamp is not None and location.timestamp > mark.timestamp
+
+def _release_seqs(db: Session, location_ids: List[int]):
+    """Clear the seq of stored fixes whose numbers a restarted tracker reuses; the rows stay as history"""
+    if location_ids:
+        db.query(BusLocation).filter(BusLocation.id.in_(location_ids)).update(
+            {BusLocation.seq: None}, synchronize_session=False
+        )
+
+def _build_row(location: BusLocationCreate, district_id: int, now: datetime, out_of_order: bool) -> BusLocation:
+    return BusLocation(
+        bus_id=location.bus_id,
+        district_id=district_id,
+        latitude=location.latitude,
+        longitude=location.longitude,
+        # Use provided timestamp or current time
+        timestamp=location.timestamp or now,
+        device_id=_device_key(location)[1] if location.seq is not None else location.device_id,
+        seq=location.seq,
+        out_of_order=out_of_order
+    )
+
+def ingest_location(db: Session, location_data: BusLocationCreate) -> BusLocation:
+    """Store a single GPS fix and return the location record"""
+    return ingest_locations(db, [location_data])[0]
+
+def ingest_locations(db: Session, locations: List[BusLocationCreate]) -> List[BusLocation]:
+    """
+    Store a batch of GPS fixes, one transaction per district
+    Returns one record per input fix; retried fixes map to the stored row
+    Raises 404 if any fix references an unknown bus
+    """
+    if not locations:
+        return []
+
+    # Verify every referenced bus exists with one query
+    bus_ids = {location.bus_id for location in locations}
+    districts = dict(db.query(Bus.id, Bus.district_id).filter(Bus.id.in_(bus_ids)).all())
+    if bus_ids - districts.keys():
+        raise HTTPException(status_code=404, detail="Bus not found")
+    sharding.remember_districts(districts.items())
+
+    by_district: Dict[int, List[int]] = {}
+    for index, location in enumerate(locations):
+        by_district.setdefault(districts[location.bus_id], []).append(index)
+
+    now = datetime.utcnow()
+    results: List[Optional[BusLocation]] = [None] * len(locations)
+    inserted: List[BusLocation] = []
+    with sharding.LocationShards(db) as shards:
+        for district_id, indexes in by_district.items():
+            inserted += _store_fixes(
+                shards.session(district_id), district_id, locations, indexes, now, results
+            )
+
+    newest: Dict[int, BusLocation] = {}
+    for row in inserted:
+        metrics.record_fix(row.bus_id, row.timestamp)
+        if row.out_of_order:
+            continue
+        current = newest.get(row.bus_id)
+        if current is None or row.timestamp >= current.timestamp:
+            newest[row.bus_id] = row
+
+    # Recompute station statuses once per bus for everyone riding it,
+    # then raise approaching/arrived alerts for the stops near the bus
+    for bus_id, row in newest.items():
+        snapshots.refresh_bus(db, bus_id, row)
+        geofence.process_fix(db, row)
+
+    return results
+
+def _store_fixes(
+    db: Session,
+    district_id: int,
+    locations: List[BusLocationCreate],
+    indexes: List[int],
+    now: datetime,
+    results: List[Optional[BusLocation]]
+) -> List[BusLocation]:
+    """
+    Store one district's fixes in its location database, filling `results`
+    Returns the rows actually inserted
+    """
+    pending: List[Tuple[int, BusLocationCreate, BusLocation]] = []
+    batch_marks: Dict[Tuple[int, str], SeqMark] = {}
+    restarted = set()
+    batch_rows: Dict[Tuple[int, str, int], BusLocation] = {}
+    repeats: List[Tuple[int, Tuple[int, str, int]]] = []
+    released: List[int] = []
+
+    for index in indexes:
+        location = locations[index]
+        if location.seq is None:
+            pending.append((index, location, _build_row(location, district_id, now, False)))
+            continue
+
+        key = _device_key(location)
+        identity = key + (location.seq,)
+        if identity in batch_rows:
+            # Same fix twice in one batch
+            repeats.append((index, identity))
+            metrics.FIXES_DUPLICATE.inc()
+            continue
+
+        mark = batch_marks.get(key) or _high_water_mark(db, key)
+        restart = _is_restart(mark, location)
+        if location.seq <= mark.ceiling:
+            stored = _stored_fix(db, key[0], key[1], location.seq)
+            if stored and _same_fix(stored, location):
+                results[index] = stored
+                metrics.FIXES_DUPLICATE.inc()
+                continue
+            if stored:
+                # A different fix under a stored seq: the tracker counts from the start
+                # again, unless the fix is older than the live position
+                released.append(stored.id)
+                older = location.timestamp is not None and mark.timestamp is not None and location.timestamp < mark.timestamp
+                restart = restart or (location.seq <= mark.seq and not older)
+
+        if restart:
+            metrics.FIXES_SEQ_RESTART.inc()
+            restarted.add(key)
+        out_of_order = not restart and location.seq < mark.seq
+        if out_of_order:
+            metrics.FIXES_OUT_OF_ORDER.inc()
+        if restart or location.seq > mark.seq:
+            mark = SeqMark(location.seq, location.timestamp or now, max(mark.ceiling, location.seq))
+        batch_marks[key] = mark
+        row = _build_row(location, district_id, now, out_of_order)
+        batch_rows[identity] = row
+        pending.append((index, location, row))
+
+    _release_seqs(db, released)
+    db.add_all(row for _, _, row in pending)
+    try:
+        db.commit()
+        inserted = [row for _, _, row in pending]
+    except IntegrityError:
+        # Another worker stored one of these first; store one by one
+        db.rollback()
+        inserted = []
+        for position, (index, location, row) in enumerate(pending):
+            retry = _build_row(location, district_id, now, row.out_of_order)
+            stored = None
+            if location.seq is not None:
+                stored = _stored_fix(db, location.bus_id, _device_key(location)[1], location.seq)
+            if stored and _same_fix(stored, location):
+                retry = stored
+                metrics.FIXES_DUPLICATE.inc()
+            else:
+                if stored:
+                    _release_seqs(db, [stored.id])
+                db.add(retry)
+                try:
+                    db.commit()
+                    inserted.append(retry)
+                except IntegrityError:
+                    db.rollback()
+                    retry = _stored_fix(db, location.bus_id, _device_key(location)[1], location.seq)
+                    metrics.FIXES_DUPLICATE.inc()
+            pending[position] = (index, location, retry)
+            if location.seq is not None:
+                batch_rows[_device_key(location) + (location.seq,)] = retry
+
+    for index, location, row in pending:
+        results[index] = row
+    for index, identity in repeats:
+        results[index] = batch_rows[identity]
+
+    # Load every returned row while its session is open; shard sessions
+    # are closed before the response is built
+    for row in {id(row): row for row in (results[index] for index in indexes)}.values():
+        if inspect(row).expired:
+            db.refresh(row)
+
+    for key, mark in batch_marks.items():
+        current = _high_water.get(key)
+        if current is not None and key not in restarted and mark.seq <= current.seq:
+            # Another request in this worker moved the live position further
+            mark = SeqMark(current.seq, current.timestamp, max(mark.ceiling, current.ceiling))
+        elif current is not None:
+            mark.ceiling = max(mark.ceiling, current.ceiling)
+        _high_water[key] = mark
+
+    return inserted
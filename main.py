@@ -1,19 +1,26 @@
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi import Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import Request, Form, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, PlainTextResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 from datetime import timedelta
-from database import get_db, Student, Bus, Station, BusLocation, Admin
-from models import LoginRequest, Token
-from auth import authenticate_user, create_access_token, get_password_hash
+from typing import Optional
+from database import get_db, get_read_db, Student, Bus, Station, Admin
+from models import LoginRequest, Token, BusLocationCreate, PageResponse
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from ingest import ingest_location
+from auth import authenticate_user, create_access_token, get_password_hash, get_current_admin, get_optional_admin
 from config import ACCESS_TOKEN_EXPIRE_MINUTES
+from metrics import MetricsMiddleware, REGISTRY
+from health import readiness_report
+from profiling import ProfilingMiddleware
+from admission import AdmissionMiddleware
 import admin_routes
 import student_routes
 import bus_routes
-import os
+import geofence
 
 app = FastAPI(
     title="School Bus Tracking API",
@@ -30,15 +37,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Opt-in request profiling (PROFILING_ENABLED or signed X-Profile header)
+app.add_middleware(ProfilingMiddleware)
+
+# Rate limits and a bounded queue for GPS ingest, ahead of the threadpool
+app.add_middleware(AdmissionMiddleware)
+
+# Request latency and per-request SQL metrics, exposed at /metrics
+app.add_middleware(MetricsMiddleware)
+
 # Include routers
 app.include_router(admin_routes.router)
 app.include_router(student_routes.router)
 app.include_router(bus_routes.router)
 
-# Create directories if they don't exist
-os.makedirs("static", exist_ok=True)
-os.makedirs("templates", exist_ok=True)
-
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
@@ -56,19 +68,49 @@ async def dashboard(request: Request):
     return templates.TemplateResponse("dashboard.html", {"request": request})
 
 @app.get("/gui/admin", response_class=HTMLResponse)
-async def admin_dashboard(request: Request, db: Session = Depends(get_db)):
-    buses = db.query(Bus).all()
-    students = db.query(Student).all()
-    stations = db.query(Station).all()
-    return templates.TemplateResponse("admin.html", {
-        "request": request,
-        "buses": buses,
-        "students": students,
-        "stations": stations
-    })
+async def admin_dashboard(request: Request):
+    # Tables and selects are filled page by page from /gui/admin/data/*,
+    # which need the admin token the page signs in for
+    return templates.TemplateResponse("admin.html", {"request": request})
+
+@app.get("/gui/admin/data/students", response_model=PageResponse)
+def admin_students_data(
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    bus_id: Optional[int] = None,
+    station_id: Optional[int] = None,
+    name_prefix: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_read_db),
+    current_admin = Depends(get_current_admin)
+):
+    return admin_routes.student_page(db, cursor, limit, bus_id, station_id, name_prefix, fields, current_admin.district_id)
+
+@app.get("/gui/admin/data/buses", response_model=PageResponse)
+def admin_buses_data(
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    bus_number_prefix: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_read_db),
+    current_admin = Depends(get_current_admin)
+):
+    return admin_routes.bus_page(db, cursor, limit, bus_number_prefix, fields, current_admin.district_id)
+
+@app.get("/gui/admin/data/stations", response_model=PageResponse)
+def admin_stations_data(
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    bus_id: Optional[int] = None,
+    name_prefix: Optional[str] = None,
+    fields: Optional[str] = None,
+    db: Session = Depends(get_read_db),
+    current_admin = Depends(get_current_admin)
+):
+    return admin_routes.station_page(db, cursor, limit, bus_id, name_prefix, fields, current_admin.district_id)
 
 @app.get("/gui/student", response_class=HTMLResponse)
-async def student_dashboard(request: Request, db: Session = Depends(get_db)):
+async def student_dashboard(request: Request, db: Session = Depends(get_read_db)):
     buses = db.query(Bus).all()
     return templates.TemplateResponse("student.html", {
         "request": request,
@@ -80,7 +122,7 @@ async def api_documentation(request: Request):
     return templates.TemplateResponse("api_docs.html", {"request": request})
 
 @app.get("/gui/bus-simulator", response_class=HTMLResponse)
-async def bus_simulator(request: Request, db: Session = Depends(get_db)):
+async def bus_simulator(request: Request, db: Session = Depends(get_read_db)):
     buses = db.query(Bus).all()
     return templates.TemplateResponse("bus_simulator.html", {
         "request": request,
@@ -94,7 +136,8 @@ async def create_bus_form(
     bus_number: str = Form(...),
     driver_name: str = Form(...),
     driver_phone: str = Form(...),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    current_admin = Depends(get_current_admin)
 ):
     # Check if bus number already exists
     if db.query(Bus).filter(Bus.bus_number == bus_number).first():
@@ -103,7 +146,8 @@ async def create_bus_form(
     db_bus = Bus(
         bus_number=bus_number,
         driver_name=driver_name,
-        driver_phone=driver_phone
+        driver_phone=driver_phone,
+        district_id=current_admin.district_id
     )
     db.add(db_bus)
     db.commit()
@@ -117,16 +161,23 @@ async def create_station_form(
     longitude: float = Form(...),
     bus_id: int = Form(...),
     order_number: int = Form(...),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    current_admin = Depends(get_current_admin)
 ):
+    bus = db.query(Bus).filter(Bus.id == bus_id, Bus.district_id == current_admin.district_id).first()
+    if not bus:
+        return RedirectResponse(url="/gui/admin?error=Bus not found", status_code=303)
+    
     db_station = Station(
         name=name,
         latitude=latitude,
         longitude=longitude,
         bus_id=bus_id,
-        order_number=order_number
+        order_number=order_number,
+        district_id=current_admin.district_id
     )
     db.add(db_station)
+    admin_routes.route_changed(db, [bus_id])
     db.commit()
     return RedirectResponse(url="/gui/admin?success=Station created successfully", status_code=303)
 
@@ -138,21 +189,34 @@ async def create_student_form(
     password: str = Form(...),
     assigned_bus_id: int = Form(None),
     assigned_station_id: int = Form(None),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    current_admin = Depends(get_current_admin)
 ):
     # Check if username already exists
     if db.query(Student).filter(Student.username == username).first():
         return RedirectResponse(url="/gui/admin?error=Username already exists", status_code=303)
     
+    if assigned_bus_id and not db.query(Bus).filter(
+        Bus.id == assigned_bus_id, Bus.district_id == current_admin.district_id
+    ).first():
+        return RedirectResponse(url="/gui/admin?error=Bus not found", status_code=303)
+    if assigned_station_id and not db.query(Station).filter(
+        Station.id == assigned_station_id, Station.district_id == current_admin.district_id
+    ).first():
+        return RedirectResponse(url="/gui/admin?error=Station not found", status_code=303)
+    
     hashed_password = get_password_hash(password)
     db_student = Student(
         name=name,
         username=username,
         password_hash=hashed_password,
         assigned_bus_id=assigned_bus_id if assigned_bus_id else None,
-        assigned_station_id=assigned_station_id if assigned_station_id else None
+        assigned_station_id=assigned_station_id if assigned_station_id else None,
+        district_id=current_admin.district_id
     )
     db.add(db_student)
+    if assigned_bus_id:
+        geofence.invalidate([assigned_bus_id])
     db.commit()
     return RedirectResponse(url="/gui/admin?success=Student created successfully", status_code=303)
 
@@ -161,18 +225,23 @@ async def create_admin_form(
     request: Request,
     username: str = Form(...),
     password: str = Form(...),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db),
+    current_admin = Depends(get_optional_admin)
 ):
-    # Check if admin already exists
-    existing_admin = db.query(Admin).first()
-    if existing_admin:
-        return RedirectResponse(url="/gui/admin?error=Admin already exists", status_code=303)
+    # The first admin needs no sign in; later ones join their creator's district
+    try:
+        district_id = admin_routes.new_admin_district(db, current_admin, None)
+    except HTTPException as exc:
+        return RedirectResponse(url=f"/gui/admin?error={exc.detail}", status_code=303)
+    if db.query(Admin).filter(Admin.username == username).first():
+        return RedirectResponse(url="/gui/admin?error=Username already exists", status_code=303)
     
     hashed_password = get_password_hash(password)
     db_admin = Admin(
         username=username,
         password_hash=hashed_password,
-        is_admin=True
+        is_admin=True,
+        district_id=district_id
     )
     db.add(db_admin)
     db.commit()
@@ -180,23 +249,18 @@ async def create_admin_form(
 
 # Bus simulator form handler
 @app.post("/gui/bus-simulator/update")
-async def update_bus_location_form(
+def update_bus_location_form(
     request: Request,
     bus_id: int = Form(...),
     latitude: float = Form(...),
     longitude: float = Form(...),
     db: Session = Depends(get_db)
 ):
-    from datetime import datetime
-    
-    db_location = BusLocation(
+    ingest_location(db, BusLocationCreate(
         bus_id=bus_id,
         latitude=latitude,
-        longitude=longitude,
-        timestamp=datetime.utcnow()
-    )
-    db.add(db_location)
-    db.commit()
+        longitude=longitude
+    ))
     return RedirectResponse(url="/gui/bus-simulator?success=Location updated successfully", status_code=303)
 
 # API Routes
@@ -211,7 +275,7 @@ async def login(login_data: LoginRequest, db: Session = Depends(get_db)):
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.username, "user_type": login_data.user_type},
+        data={"sub": user.username, "user_type": login_data.user_type, "district_id": user.district_id},
         expires_delta=access_token_expires
     )
     return {
@@ -227,6 +291,22 @@ async def health_check():
         "message": "School Bus Tracking API is running"
     }
 
+@app.get("/health/ready")
+async def readiness_check():
+    report = await readiness_report()
+    status_code = 200 if report["status"] == "ready" else 503
+    return JSONResponse(report, status_code=status_code)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return PlainTextResponse(
+        REGISTRY.render(),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
 if __name__ == "__main__":
     import uvicorn
+    import migrations
+    # Local development convenience; deployments run `python migrations.py upgrade`
+    migrations.upgrade()
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
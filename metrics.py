@@ -0,0 +1,294 @@
+"""
+Minimal in-process metrics registry rendered in the Prometheus text
+exposition format at /metrics.
+
+Counters and histograms are plain dicts keyed by label tuples behind a
+single lock, so recording a sample costs a dict lookup and an addition.
+"""
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+LabelValues = Tuple[str, ...]
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        key = tuple(str(label) for label in labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(tuple(str(label) for label in labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in items
+        ]
+
+class Gauge:
+    """Gauge whose samples are produced by a callback at scrape time"""
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        callback: Optional[Callable[[], Iterable[Tuple[LabelValues, float]]]] = None
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        if not self.callback:
+            return []
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in self.callback()
+        ]
+
+class Histogram:
+    kind = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[LabelValues, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        key = tuple(str(label) for label in labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            state[index] += 1
+            state[-1] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(labels, list(state)) for labels, state in self._values.items()]
+        lines = []
+        for labels, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state[:-1]):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(state[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template",
+    ("method", "route", "status")
+))
+REQUEST_DB_QUERIES = REGISTRY.register(Histogram(
+    "http_request_db_queries",
+    "Number of SQL statements executed per HTTP request",
+    ("route",),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100)
+))
+REQUEST_DB_TIME = REGISTRY.register(Histogram(
+    "http_request_db_seconds",
+    "Time spent executing SQL per HTTP request",
+    ("route",)
+))
+DB_QUERIES = REGISTRY.register(Counter(
+    "db_queries_total",
+    "SQL statements executed, including those outside HTTP requests"
+))
+FIXES_INGESTED = REGISTRY.register(Counter(
+    "bus_fixes_ingested_total",
+    "GPS fixes stored per bus",
+    ("bus_id",)
+))
+FIXES_DUPLICATE = REGISTRY.register(Counter(
+    "bus_fixes_duplicate_total",
+    "Retried GPS fixes answered from the stored row without a write"
+))
+FIXES_OUT_OF_ORDER = REGISTRY.register(Counter(
+    "bus_fixes_out_of_order_total",
+    "GPS fixes older than the live position, stored as history only"
+))
+FIXES_SEQ_RESTART = REGISTRY.register(Counter(
+    "bus_fixes_seq_restart_total",
+    "GPS fixes showing a tracker's sequence numbers started over"
+))
+ALERTS_SENT = REGISTRY.register(Counter(
+    "geofence_alerts_total",
+    "Approaching/arrived alerts raised for students"
+))
+TRIPS_STARTED = REGISTRY.register(Counter(
+    "geofence_trips_started_total",
+    "Bus trips started after a silence or a completed lap"
+))
+ALERTS_DROPPED = REGISTRY.register(Counter(
+    "geofence_alerts_dropped_total",
+    "Alerts that failed to be checked, stored or delivered, or had no room to queue"
+))
+READ_SESSIONS = REGISTRY.register(Counter(
+    "db_read_sessions_total",
+    "Read-only request sessions by target (replica/primary)",
+    ("target",)
+))
+INGEST_SHED = REGISTRY.register(Counter(
+    "ingest_requests_shed_total",
+    "Ingest requests refused by admission control, by reason",
+    ("reason",)
+))
+FIXES_SHED = REGISTRY.register(Counter(
+    "bus_fixes_shed_total",
+    "GPS fixes in ingest requests refused by admission control, by reason",
+    ("reason",)
+))
+ADMISSION_BACKEND_ERRORS = REGISTRY.register(Counter(
+    "ingest_admission_backend_errors_total",
+    "Shared rate-limit backend failures answered from in-memory buckets"
+))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    "cache_requests_total",
+    "Cache lookups by cache name and result (hit/miss)",
+    ("cache", "result")
+))
+
+# Newest fix timestamp seen per bus (naive UTC, like BusLocation.timestamp)
+_last_fix: Dict[int, datetime] = {}
+
+def record_fix(bus_id: int, timestamp: datetime):
+    FIXES_INGESTED.inc(bus_id)
+    current = _last_fix.get(bus_id)
+    if current is None or timestamp > current:
+        _last_fix[bus_id] = timestamp
+
+def last_fix_times() -> Dict[int, datetime]:
+    return dict(_last_fix)
+
+def _last_fix_ages():
+    now = datetime.utcnow()
+    for bus_id, timestamp in list(_last_fix.items()):
+        yield (str(bus_id),), max((now - timestamp).total_seconds(), 0.0)
+
+REGISTRY.register(Gauge(
+    "bus_last_fix_age_seconds",
+    "Seconds since the newest GPS fix seen by this worker, per bus",
+    ("bus_id",),
+    callback=_last_fix_ages
+))
+
+def record_cache(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache, "hit" if hit else "miss")
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+# Set per request by MetricsMiddleware. The object is mutated rather than
+# replaced so that threadpool copies of the context still report into it.
+current_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("current_request_stats", default=None)
+
+def record_query(duration: float):
+    DB_QUERIES.inc()
+    stats = current_request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += duration
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and SQL usage per route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request_stats.set(stats)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request_stats.reset(token)
+            route = scope.get("route")
+            # Label by template, never by raw path, to keep cardinality bounded
+            route_name = getattr(route, "path", "unmatched")
+            REQUEST_LATENCY.observe(elapsed, scope["method"], route_name, status_code)
+            REQUEST_DB_QUERIES.observe(stats.queries, route_name)
+            REQUEST_DB_TIME.observe(stats.db_seconds, route_name)
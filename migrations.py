@@ -0,0 +1,241 @@
+"""
+Versioned schema migrations
+
+Run once per deploy, before starting workers:
+
+    python migrations.py upgrade     # apply pending migrations
+    python migrations.py current     # print the applied version
+    python migrations.py history     # list migrations and their state
+
+Applied versions are recorded in `schema_migrations`. Every migration is
+written to be safe on databases created by the old import-time
+`create_all`, so existing deployments can run the whole list.
+
+Tables are created from the frozen definitions below, as they were when
+their migration was written, never from the live models: a fresh database
+walks through every version like an old one did. Change a table by adding
+a migration, not by editing its definition here.
+
+With LOCATION_SHARD_URL set, `upgrade` also creates the location table of
+every district's shard from the current model. Shards have no version
+table; a migration that alters `bus_locations` must apply the change to
+each shard as well.
+"""
+import argparse
+from datetime import datetime
+from sqlalchemy import (
+    MetaData, Table, Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text,
+    inspect, select, text
+)
+from sqlalchemy.engine import Connection
+from config import DEFAULT_DISTRICT_ID
+from database import engine, Bus
+import sharding
+
+# Frozen table definitions, each as of the migration that creates it
+_frozen = MetaData()
+
+# Version 1: the schema the old import-time create_all built
+Table(
+    "students", _frozen,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("name", String, nullable=False),
+    Column("username", String, unique=True, index=True, nullable=False),
+    Column("password_hash", String, nullable=False),
+    Column("assigned_bus_id", Integer, ForeignKey("buses.id"), nullable=True),
+    Column("assigned_station_id", Integer, ForeignKey("stations.id"), nullable=True),
+)
+Table(
+    "buses", _frozen,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("bus_number", String, unique=True, nullable=False),
+    Column("driver_name", String, nullable=False),
+    Column("driver_phone", String, nullable=False),
+)
+Table(
+    "stations", _frozen,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("name", String, nullable=False),
+    Column("latitude", Float, nullable=False),
+    Column("longitude", Float, nullable=False),
+    Column("bus_id", Integer, ForeignKey("buses.id"), nullable=False),
+    Column("order_number", Integer, nullable=False),
+)
+Table(
+    "bus_locations", _frozen,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("bus_id", Integer, ForeignKey("buses.id"), nullable=False),
+    Column("latitude", Float, nullable=False),
+    Column("longitude", Float, nullable=False),
+    Column("timestamp", DateTime),
+)
+Table(
+    "admins", _frozen,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("username", String, unique=True, index=True, nullable=False),
+    Column("password_hash", String, nullable=False),
+    Column("is_admin", Boolean),
+)
+
+# Version 3
+Table(
+    "bus_status_snapshots", _frozen,
+    Column("bus_id", Integer, ForeignKey("buses.id"), primary_key=True),
+    Column("location_id", Integer, nullable=True),
+    Column("payload", Text, nullable=False),
+    Column("updated_at", DateTime, nullable=False),
+)
+Table(
+    "student_alerts", _frozen,
+    Column("id", Integer, primary_key=True, index=True),
+    Column("student_id", Integer, ForeignKey("students.id"), nullable=False, index=True),
+    Column("bus_id", Integer, ForeignKey("buses.id"), nullable=False),
+    Column("station_id", Integer, ForeignKey("stations.id"), nullable=False),
+    Column("kind", String, nullable=False),
+    Column("distance_km", Float, nullable=False),
+    Column("eta_minutes", Integer, nullable=True),
+    Column("created_at", DateTime, nullable=False),
+)
+
+# Version 7
+Table(
+    "bus_trips", _frozen,
+    Column("bus_id", Integer, ForeignKey("buses.id"), primary_key=True),
+    Column("trip_key", String, nullable=False),
+    Column("started_at", DateTime, nullable=False),
+    Column("last_fix_at", DateTime, nullable=False),
+    Column("reached_end", Boolean, nullable=False),
+)
+
+def _create_tables(conn: Connection, *names: str):
+    for name in names:
+        _frozen.tables[name].create(bind=conn, checkfirst=True)
+
+def _add_column(conn: Connection, table: str, column: str, ddl: str):
+    if column not in {c["name"] for c in inspect(conn).get_columns(table)}:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+def _district_ids(conn: Connection) -> list:
+    return [row[0] for row in conn.execute(select(Bus.district_id).distinct())]
+
+def _create_index(conn: Connection, name: str, table: str, columns: str, unique: bool = False):
+    unique_sql = "UNIQUE " if unique else ""
+    conn.execute(text(f"CREATE {unique_sql}INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
+def initial_schema(conn: Connection):
+    _create_tables(conn, "buses", "stations", "students", "bus_locations", "admins")
+
+def bus_location_sequencing(conn: Connection):
+    _add_column(conn, "bus_locations", "device_id", "VARCHAR")
+    _add_column(conn, "bus_locations", "seq", "BIGINT")
+    _add_column(conn, "bus_locations", "out_of_order", "BOOLEAN NOT NULL DEFAULT FALSE")
+    _create_index(conn, "uq_bus_locations_device_seq", "bus_locations", "bus_id, device_id, seq", unique=True)
+
+def snapshots_and_alerts(conn: Connection):
+    _create_tables(conn, "bus_status_snapshots", "student_alerts")
+
+def read_path_indexes(conn: Connection):
+    _create_index(conn, "ix_bus_locations_bus_id_timestamp", "bus_locations", "bus_id, timestamp")
+    _create_index(conn, "ix_stations_bus_id_order_number", "stations", "bus_id, order_number")
+    _create_index(conn, "ix_students_assigned_bus_id", "students", "assigned_bus_id")
+    _create_index(conn, "ix_students_assigned_station_id", "students", "assigned_station_id")
+
+def districts(conn: Connection):
+    for table in ("buses", "stations", "students", "bus_locations", "admins"):
+        _add_column(conn, table, "district_id", f"INTEGER NOT NULL DEFAULT {DEFAULT_DISTRICT_ID}")
+        _create_index(conn, f"ix_{table}_district_id", table, "district_id")
+
+def bus_location_seq_bigint(conn: Connection):
+    # Trackers may number fixes beyond 32 bits; SQLite integers are 64-bit already
+    widen = "ALTER TABLE bus_locations ALTER COLUMN seq TYPE BIGINT"
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(widen))
+    if sharding.sharding_enabled():
+        for district_id in _district_ids(conn):
+            with sharding.shard_engine(district_id).begin() as shard_conn:
+                if shard_conn.dialect.name == "postgresql":
+                    shard_conn.execute(text(widen))
+
+def persistent_trips(conn: Connection):
+    _create_tables(conn, "bus_trips")
+    _add_column(conn, "student_alerts", "trip_key", "VARCHAR")
+    _create_index(conn, "uq_student_alerts_trip", "student_alerts", "student_id, station_id, kind, trip_key", unique=True)
+
+# (version, name, function) in the order they must run; never renumber
+MIGRATIONS = [
+    (1, "initial schema", initial_schema),
+    (2, "bus location sequencing", bus_location_sequencing),
+    (3, "status snapshots and student alerts", snapshots_and_alerts),
+    (4, "read path indexes", read_path_indexes),
+    (5, "districts", districts),
+    (6, "bus location seq bigint", bus_location_seq_bigint),
+    (7, "persistent trips", persistent_trips),
+]
+
+def _ensure_version_table(conn: Connection):
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at TIMESTAMP NOT NULL)"
+    ))
+
+def applied_versions(conn: Connection) -> set:
+    _ensure_version_table(conn)
+    return {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+def current_version() -> int:
+    with engine.begin() as conn:
+        return max(applied_versions(conn), default=0)
+
+def upgrade() -> list:
+    """Apply pending migrations, each in its own transaction; returns the versions applied"""
+    applied = []
+    with engine.begin() as conn:
+        done = applied_versions(conn)
+    for version, name, migrate in MIGRATIONS:
+        if version in done:
+            continue
+        with engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                # Serialize concurrent deploys; released when this transaction ends
+                conn.execute(text("SELECT pg_advisory_xact_lock(7304011)"))
+            # Another deploy may have applied it while we waited for the lock
+            if version in applied_versions(conn):
+                continue
+            migrate(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :applied_at)"),
+                {"version": version, "name": name, "applied_at": datetime.utcnow()}
+            )
+        applied.append(version)
+
+    if sharding.sharding_enabled():
+        # Location shards of existing districts; new ones are created on first use
+        with engine.begin() as conn:
+            district_ids = _district_ids(conn)
+        for district_id in district_ids:
+            sharding.shard_sessionmaker(district_id)
+    return applied
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the database schema")
+    parser.add_argument("command", choices=["upgrade", "current", "history"])
+    args = parser.parse_args()
+
+    if args.command == "upgrade":
+        applied = upgrade()
+        if applied:
+            print(f"applied migrations: {', '.join(str(v) for v in applied)}")
+        else:
+            print("database is up to date")
+        print(f"schema version: {current_version()}")
+    elif args.command == "current":
+        print(current_version())
+    else:
+        with engine.begin() as conn:
+            done = applied_versions(conn)
+        for version, name, _ in MIGRATIONS:
+            state = "applied" if version in done else "pending"
+            print(f"{version:>4}  {state:<8} {name}")
+
+if __name__ == "__main__":
+    main()
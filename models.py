@@ -1,6 +1,7 @@
-from pydantic import BaseModel
-from datetime import datetime
-from typing import Optional, List
+from pydantic import BaseModel, Field, validator
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Any
+from config import INGEST_MAX_BATCH
 
 # Authentication Models
 class Token(BaseModel):
@@ -11,6 +12,7 @@ class Token(BaseModel):
 class TokenData(BaseModel):
     username: Optional[str] = None
     user_type: Optional[str] = None
+    district_id: Optional[int] = None
 
 class LoginRequest(BaseModel):
     username: str
@@ -29,6 +31,7 @@ class StudentCreate(StudentBase):
 
 class StudentResponse(StudentBase):
     id: int
+    district_id: Optional[int] = None
     
     class Config:
         from_attributes = True
@@ -44,6 +47,7 @@ class BusCreate(BusBase):
 
 class BusResponse(BusBase):
     id: int
+    district_id: Optional[int] = None
     
     class Config:
         from_attributes = True
@@ -75,16 +79,31 @@ class StationWithStatus(StationBase):
 
 class StationResponse(StationBase):
     id: int
+    district_id: Optional[int] = None
     
     class Config:
         from_attributes = True
 
 # Bus Location Models
+MAX_SEQ = 2 ** 63 - 1  # bus_locations.seq is a BIGINT
+
 class BusLocationCreate(BaseModel):
     bus_id: int
     latitude: float
     longitude: float
     timestamp: Optional[datetime] = None
+    device_id: Optional[str] = None  # Tracker identifier, scopes seq
+    seq: Optional[int] = Field(None, ge=0, le=MAX_SEQ)  # Per-device sequence number for retry deduplication
+
+    @validator("timestamp")
+    def naive_utc(cls, timestamp: Optional[datetime]) -> Optional[datetime]:
+        # Stored timestamps are naive UTC; compare and store "...Z" fixes the same way
+        if timestamp is not None and timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        return timestamp
+
+class BusLocationBatch(BaseModel):
+    locations: List[BusLocationCreate] = Field(..., max_items=INGEST_MAX_BATCH)
 
 class BusLocationResponse(BaseModel):
     id: int
@@ -92,11 +111,45 @@ class BusLocationResponse(BaseModel):
     latitude: float
     longitude: float
     timestamp: datetime
+    seq: Optional[int] = None
+    out_of_order: bool = False
     
     class Config:
         from_attributes = True
 
+# Alert Models
+class StudentAlertResponse(BaseModel):
+    id: int
+    bus_id: int
+    station_id: int
+    kind: str  # "approaching" or "arrived"
+    distance_km: float
+    eta_minutes: Optional[int] = None
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+# Route Import Models
+class RouteImportBusResult(BaseModel):
+    bus_id: int
+    inserted: int
+    updated: int
+    deleted: int
+    unchanged: int
+    unassigned_students: int  # Riders of deleted stations, now without a station
+
+class RouteImportResponse(BaseModel):
+    dry_run: bool
+    buses: List[RouteImportBusResult]
+
+# Pagination Models
+class PageResponse(BaseModel):
+    items: List[Dict[str, Any]]
+    next_cursor: Optional[str] = None
+
 # Admin Models
 class AdminCreate(BaseModel):
     username: str
-    password: str
\ No newline at end of file
+    password: str
+    district_id: Optional[int] = None  # Another district; only admins of DEFAULT_DISTRICT_ID may set it
\ No newline at end of file
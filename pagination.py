@@ -0,0 +1,56 @@
+"""
+Keyset (cursor) pagination helpers for list endpoints
+
+Pages are ordered by primary key and continue with `id > last_id`, so the
+cost of a page does not grow with how deep into the table it is. Cursors
+are opaque to clients.
+"""
+import base64
+from typing import List, Optional, Sequence
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(f"id:{last_id}".encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: Optional[str]) -> Optional[int]:
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        prefix, _, value = base64.urlsafe_b64decode(padded.encode()).decode().partition(":")
+        if prefix != "id":
+            raise ValueError(cursor)
+        return int(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def select_fields(fields: Optional[str], allowed: Sequence[str]) -> List[str]:
+    """Parse a comma separated projection; id is always included for the cursor"""
+    if not fields:
+        return list(allowed)
+    requested = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in requested if field not in allowed]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return ["id"] + [field for field in requested if field != "id"]
+
+def paginate(db: Session, model, columns: Sequence[str], filters: list, cursor: Optional[str], limit: int) -> dict:
+    """Return one page of `columns` from `model` as {"items", "next_cursor"}"""
+    after = decode_cursor(cursor)
+    query = db.query(*[getattr(model, column) for column in columns]).filter(*filters)
+    if after is not None:
+        query = query.filter(model.id > after)
+
+    # Fetch one extra row to know whether another page exists
+    rows = query.order_by(model.id).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    return {
+        "items": [dict(row._mapping) for row in rows],
+        "next_cursor": encode_cursor(rows[-1].id) if has_more and rows else None
+    }
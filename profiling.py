@@ -0,0 +1,238 @@
+"""
+Opt-in per-request profiling
+
+A request is profiled when PROFILING_ENABLED is set, or when it carries an
+`X-Profile` header signed with SECRET_KEY (issued to admins through
+POST /admin/profiles/token). Profiles of requests slower than
+PROFILING_THRESHOLD_MS - and every header-triggered request - are kept in
+memory together with the SQL they ran, newest PROFILING_KEEP only.
+
+Modes:
+    sample    - a background thread samples the stacks of the event loop
+                thread and of every thread that ran SQL for the request;
+                output is collapsed stacks (flamegraph.pl / speedscope)
+    cprofile  - deterministic cProfile of the event loop thread, which is
+                where async routes such as /gui/admin render templates.
+                Only one request holds the profiler, but coroutines of
+                other requests that run on the loop meanwhile are recorded
+                in its profile too; profile on a quiet worker
+
+When neither switch is on, the middleware only scans the request headers.
+"""
+import cProfile
+import hashlib
+import hmac
+import io
+import itertools
+import marshal
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import List, Optional
+from config import (
+    SECRET_KEY, PROFILING_ENABLED, PROFILING_MODE, PROFILING_THRESHOLD_MS,
+    PROFILING_SAMPLE_INTERVAL_MS, PROFILING_KEEP, PROFILING_TOKEN_EXPIRE_MINUTES
+)
+
+PROFILE_HEADER = b"x-profile"
+MAX_LOGGED_QUERIES = 500
+
+_profiles: deque = deque(maxlen=PROFILING_KEEP)
+_profile_ids = itertools.count(1)
+
+def create_profile_token(expires_delta: Optional[timedelta] = None) -> str:
+    """Signed value for the X-Profile header"""
+    expires_delta = expires_delta or timedelta(minutes=PROFILING_TOKEN_EXPIRE_MINUTES)
+    expire = int((datetime.utcnow() + expires_delta).timestamp())
+    return f"{expire}.{_sign(str(expire))}"
+
+def verify_profile_token(token: str) -> bool:
+    expire, _, signature = token.partition(".")
+    if not expire.isdigit() or not hmac.compare_digest(signature, _sign(expire)):
+        return False
+    return int(expire) >= datetime.utcnow().timestamp()
+
+def _sign(value: str) -> str:
+    return hmac.new(SECRET_KEY.encode(), f"profile:{value}".encode(), hashlib.sha256).hexdigest()
+
+class ProfileSession:
+    def __init__(self, scope, forced: bool):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.forced = forced
+        self.started_at = datetime.utcnow()
+        self.queries: List[dict] = []
+        self.threads = {threading.get_ident()}
+        self.stacks: Counter = Counter()
+        self.samples = 0
+
+    def record_query(self, statement: str, duration: float):
+        self.threads.add(threading.get_ident())
+        if len(self.queries) < MAX_LOGGED_QUERIES:
+            self.queries.append({"sql": statement, "ms": round(duration * 1000, 3)})
+
+current_session: ContextVar[Optional[ProfileSession]] = ContextVar("current_profile_session", default=None)
+
+def record_query(statement: str, duration: float):
+    """Called from the engine cursor hook in database.py"""
+    session = current_session.get()
+    if session is not None:
+        session.record_query(statement, duration)
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class StackSampler:
+    """Samples the threads of all active sessions while any are running"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.sessions = set()
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+
+    def add(self, session: ProfileSession):
+        with self.lock:
+            self.sessions.add(session)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="profiling-sampler", daemon=True)
+                self.thread.start()
+
+    def remove(self, session: ProfileSession):
+        with self.lock:
+            self.sessions.discard(session)
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while True:
+            with self.lock:
+                if not self.sessions:
+                    self.thread = None
+                    return
+                sessions = list(self.sessions)
+            frames = sys._current_frames()
+            for session in sessions:
+                session.samples += 1
+                for ident in list(session.threads):
+                    frame = frames.get(ident)
+                    if frame is not None and ident != own_ident:
+                        session.stacks[_collapse(frame)] += 1
+            time.sleep(self.interval)
+
+_sampler = StackSampler(PROFILING_SAMPLE_INTERVAL_MS / 1000)
+_cprofile_lock = threading.Lock()
+
+def list_profiles() -> List[dict]:
+    return [
+        {key: value for key, value in profile.items() if key not in ("queries", "data")}
+        for profile in reversed(_profiles)
+    ]
+
+def get_profile(profile_id: int) -> Optional[dict]:
+    return next((profile for profile in _profiles if profile["id"] == profile_id), None)
+
+def render_profile(profile: dict) -> str:
+    """Human-readable profile: query log followed by stacks or pstats"""
+    out = io.StringIO()
+    out.write(f"# {profile['method']} {profile['path']} -> {profile['status']} "
+              f"in {profile['duration_ms']} ms ({profile['mode']})\n")
+    out.write(f"# {len(profile['queries'])} SQL statements, {profile['db_ms']} ms\n")
+    for query in profile["queries"]:
+        out.write(f"#   {query['ms']:>9} ms  {' '.join(query['sql'].split())}\n")
+    out.write("\n")
+    if profile["mode"] == "cprofile":
+        stats = pstats.Stats(_StatsHolder(marshal.loads(profile["data"])), stream=out)
+        stats.sort_stats("cumulative").print_stats(60)
+    else:
+        for stack, count in sorted(profile["data"].items(), key=lambda item: -item[1]):
+            out.write(f"{stack} {count}\n")
+    return out.getvalue()
+
+class _StatsHolder:
+    """Lets pstats.Stats load raw stats without a file"""
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+def _store(session: ProfileSession, mode: str, duration: float, status: int, data):
+    _profiles.append({
+        "id": next(_profile_ids),
+        "method": session.method,
+        "path": session.path,
+        "status": status,
+        "mode": mode,
+        "forced": session.forced,
+        "started_at": session.started_at.isoformat(),
+        "duration_ms": round(duration * 1000, 2),
+        "db_ms": round(sum(query["ms"] for query in session.queries), 3),
+        "query_count": len(session.queries),
+        "queries": session.queries,
+        "data": data,
+    })
+
+def _header_forced(scope) -> bool:
+    for name, value in scope["headers"]:
+        if name == PROFILE_HEADER:
+            return verify_profile_token(value.decode("latin-1"))
+    return False
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        forced = _header_forced(scope)
+        if not forced and not PROFILING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        session = ProfileSession(scope, forced)
+        token = current_session.set(session)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        profiler = None
+        if PROFILING_MODE == "cprofile":
+            if _cprofile_lock.acquire(blocking=False):
+                profiler = cProfile.Profile()
+                profiler.enable()
+        else:
+            _sampler.add(session)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - started
+            current_session.reset(token)
+            if profiler is not None:
+                profiler.disable()
+                _cprofile_lock.release()
+            elif PROFILING_MODE != "cprofile":
+                _sampler.remove(session)
+
+            if forced or duration * 1000 >= PROFILING_THRESHOLD_MS:
+                if profiler is not None:
+                    profiler.create_stats()
+                    _store(session, "cprofile", duration, status_code, marshal.dumps(profiler.stats))
+                elif PROFILING_MODE != "cprofile":
+                    _store(session, "sample", duration, status_code, dict(session.stacks))
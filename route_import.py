@@ -0,0 +1,293 @@
+"""
+Bulk route import for POST /admin/routes/import
+
+A route is the ordered list of stops of one bus. Whole routes for one or
+many buses arrive as JSON, CSV or GeoJSON, are validated, diffed against
+the buses' current stations and applied in one transaction with bulk
+statements:
+
+- a stop with an `id` updates that station, which must be on the same bus
+- a stop without one takes over an unclaimed station of the same name on
+  the bus, otherwise it is inserted
+- stations the route no longer lists are deleted; their riders keep the
+  bus but lose the station, and their alerts are removed
+- `order_number` becomes the stop's position in the route, starting at 1
+
+Stops are in input order unless every stop of a route has `order_number`,
+in which case they are sorted by it.
+"""
+import csv
+import io
+import json
+from collections import defaultdict, deque
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi import HTTPException
+from sqlalchemy import delete, func, insert, update
+from sqlalchemy.orm import Session
+from database import Bus, Station, Student, StudentAlert
+
+FORMATS = ("json", "csv", "geojson")
+
+# (label for error messages, raw bus_id, [(label, raw stop)])
+RawRoute = Tuple[str, Any, List[Tuple[str, Any]]]
+
+@dataclass
+class RouteDiff:
+    bus_id: int
+    inserts: List[dict] = field(default_factory=list)
+    updates: List[dict] = field(default_factory=list)
+    deletes: List[int] = field(default_factory=list)
+    unchanged: int = 0
+    unassigned_students: int = 0
+
+    def summary(self) -> dict:
+        return {
+            "bus_id": self.bus_id,
+            "inserted": len(self.inserts),
+            "updated": len(self.updates),
+            "deleted": len(self.deletes),
+            "unchanged": self.unchanged,
+            "unassigned_students": self.unassigned_students,
+        }
+
+def _invalid(errors: List[str]) -> HTTPException:
+    return HTTPException(status_code=400, detail={"errors": errors})
+
+def detect_format(content_type: str, body: bytes) -> str:
+    content_type = content_type.split(";")[0].strip().lower()
+    if content_type in FORMATS:
+        return content_type
+    if content_type in ("text/csv", "application/csv"):
+        return "csv"
+    if content_type == "application/geo+json":
+        return "geojson"
+    if b'"FeatureCollection"' in body:
+        return "geojson"
+    return "json"
+
+def _from_json(data: Any) -> List[RawRoute]:
+    if not isinstance(data, dict) or not isinstance(data.get("routes"), list):
+        raise _invalid(['body: expected {"routes": [{"bus_id": ..., "stops": [...]}]}'])
+    routes = []
+    for i, route in enumerate(data["routes"]):
+        label = f"routes[{i}]"
+        if not isinstance(route, dict) or not isinstance(route.get("stops"), list):
+            raise _invalid([f"{label}: expected an object with bus_id and a stops list"])
+        stops = [(f"{label}.stops[{j}]", stop) for j, stop in enumerate(route["stops"])]
+        routes.append((label, route.get("bus_id"), stops))
+    return routes
+
+def _from_csv(text: str) -> List[RawRoute]:
+    reader = csv.DictReader(io.StringIO(text))
+    missing = {"bus_id", "name", "latitude", "longitude"} - set(reader.fieldnames or [])
+    if missing:
+        raise _invalid([f"header: missing columns {', '.join(sorted(missing))}"])
+    # Rows of each bus, in file order
+    grouped: Dict[str, List[Tuple[str, dict]]] = {}
+    for row in reader:
+        grouped.setdefault((row["bus_id"] or "").strip(), []).append((f"line {reader.line_num}", row))
+    return [(f"bus_id {bus_id}", bus_id, stops) for bus_id, stops in grouped.items()]
+
+def _from_geojson(data: Any) -> List[RawRoute]:
+    if not isinstance(data, dict) or data.get("type") != "FeatureCollection":
+        raise _invalid(["body: expected a GeoJSON FeatureCollection"])
+    grouped: Dict[Any, List[Tuple[str, Any]]] = {}
+    errors = []
+    for k, feature in enumerate(data.get("features") or []):
+        label = f"features[{k}]"
+        geometry = (feature or {}).get("geometry") or {}
+        coordinates = geometry.get("coordinates")
+        if geometry.get("type") != "Point" or not isinstance(coordinates, list) or len(coordinates) < 2:
+            errors.append(f"{label}: geometry must be a Point")
+            continue
+        properties = dict(feature.get("properties") or {})
+        # GeoJSON positions are [longitude, latitude]
+        properties["longitude"], properties["latitude"] = coordinates[0], coordinates[1]
+        grouped.setdefault(properties.get("bus_id"), []).append((label, properties))
+    if errors:
+        raise _invalid(errors)
+    return [(f"bus_id {bus_id}", bus_id, stops) for bus_id, stops in grouped.items()]
+
+def _integer(value: Any) -> Optional[int]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+        return int(value)
+    return None
+
+def _number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _blank(value: Any) -> bool:
+    return value is None or (isinstance(value, str) and not value.strip())
+
+def _clean_stop(label: str, stop: Any, errors: List[str]) -> Optional[dict]:
+    if not isinstance(stop, dict):
+        errors.append(f"{label}: expected an object")
+        return None
+    count = len(errors)
+    name = str(stop.get("name") or "").strip()
+    if not name:
+        errors.append(f"{label}: name is required")
+    latitude = _number(stop.get("latitude"))
+    if latitude is None or not -90 <= latitude <= 90:
+        errors.append(f"{label}: latitude must be a number between -90 and 90")
+    longitude = _number(stop.get("longitude"))
+    if longitude is None or not -180 <= longitude <= 180:
+        errors.append(f"{label}: longitude must be a number between -180 and 180")
+    station_id = None if _blank(stop.get("id")) else _integer(stop.get("id"))
+    if not _blank(stop.get("id")) and station_id is None:
+        errors.append(f"{label}: id must be an integer")
+    order_number = None if _blank(stop.get("order_number")) else _integer(stop.get("order_number"))
+    if not _blank(stop.get("order_number")) and order_number is None:
+        errors.append(f"{label}: order_number must be an integer")
+    if len(errors) > count:
+        return None
+    return {
+        "label": label,
+        "id": station_id,
+        "name": name,
+        "latitude": latitude,
+        "longitude": longitude,
+        "order_number": order_number,
+    }
+
+def parse_routes(body: bytes, format: str) -> Dict[int, List[dict]]:
+    """
+    Parse and validate routes; returns bus_id -> stops in route order
+    Raises 400 listing every problem found
+    """
+    if format not in FORMATS:
+        raise _invalid([f"format: must be one of {', '.join(FORMATS)}"])
+    try:
+        text = body.decode("utf-8-sig")
+        if format == "csv":
+            raw_routes = _from_csv(text)
+        elif format == "geojson":
+            raw_routes = _from_geojson(json.loads(text))
+        else:
+            raw_routes = _from_json(json.loads(text))
+    except (UnicodeDecodeError, ValueError, csv.Error) as exc:
+        raise _invalid([f"body: could not be parsed as {format} ({exc})"])
+
+    errors: List[str] = []
+    routes: Dict[int, List[dict]] = {}
+    for label, raw_bus_id, raw_stops in raw_routes:
+        bus_id = _integer(raw_bus_id)
+        if bus_id is None:
+            errors.append(f"{label}: bus_id must be an integer")
+        elif bus_id in routes:
+            errors.append(f"{label}: bus {bus_id} appears more than once")
+        stops = [_clean_stop(stop_label, stop, errors) for stop_label, stop in raw_stops]
+        stops = [stop for stop in stops if stop]
+        numbered = [stop for stop in stops if stop["order_number"] is not None]
+        if numbered and len(numbered) != len(stops):
+            errors.append(f"{label}: give order_number for every stop of the route or for none")
+        elif numbered:
+            stops.sort(key=lambda stop: stop["order_number"])
+        seen_ids = set()
+        for stop in stops:
+            if stop["id"] is not None:
+                if stop["id"] in seen_ids:
+                    errors.append(f"{stop['label']}: station {stop['id']} is listed twice")
+                seen_ids.add(stop["id"])
+        if bus_id is not None:
+            routes.setdefault(bus_id, stops)
+    if not raw_routes:
+        errors.append("body: no routes given")
+    if errors:
+        raise _invalid(errors)
+    return routes
+
+def plan_import(db: Session, routes: Dict[int, List[dict]], district_id: int) -> List[RouteDiff]:
+    """Diff routes against the current stations with two queries; raises 400 on unknown buses or stations"""
+    bus_ids = list(routes)
+    known = {row[0] for row in db.query(Bus.id).filter(Bus.id.in_(bus_ids), Bus.district_id == district_id).all()}
+    errors = [f"bus {bus_id}: not found" for bus_id in bus_ids if bus_id not in known]
+    if errors:
+        raise _invalid(errors)
+
+    existing: Dict[int, List[Station]] = defaultdict(list)
+    for station in db.query(Station).filter(Station.bus_id.in_(bus_ids)).order_by(Station.bus_id, Station.order_number):
+        existing[station.bus_id].append(station)
+
+    diffs = []
+    for bus_id, stops in routes.items():
+        stations = existing[bus_id]
+        by_id = {station.id: station for station in stations}
+        claimed = {stop["id"] for stop in stops if stop["id"] is not None}
+        for stop in stops:
+            if stop["id"] is not None and stop["id"] not in by_id:
+                errors.append(f"{stop['label']}: station {stop['id']} is not on bus {bus_id}")
+        # Unclaimed stations by name, in route order, for stops without ids
+        by_name: Dict[str, deque] = defaultdict(deque)
+        for station in stations:
+            if station.id not in claimed:
+                by_name[station.name].append(station)
+
+        diff = RouteDiff(bus_id=bus_id)
+        kept = set()
+        for position, stop in enumerate(stops, start=1):
+            if stop["id"] is not None:
+                station = by_id.get(stop["id"])
+            else:
+                station = by_name[stop["name"]].popleft() if by_name[stop["name"]] else None
+            values = {
+                "name": stop["name"],
+                "latitude": stop["latitude"],
+                "longitude": stop["longitude"],
+                "order_number": position,
+            }
+            if station is None:
+                diff.inserts.append(dict(values, bus_id=bus_id, district_id=district_id))
+                continue
+            kept.add(station.id)
+            if any(getattr(station, key) != value for key, value in values.items()):
+                diff.updates.append(dict(values, id=station.id))
+            else:
+                diff.unchanged += 1
+        diff.deletes = [station.id for station in stations if station.id not in kept]
+        diffs.append(diff)
+    if errors:
+        raise _invalid(errors)
+
+    deleted = {station_id: diff for diff in diffs for station_id in diff.deletes}
+    if deleted:
+        riders = db.query(Student.assigned_station_id, func.count(Student.id)).filter(
+            Student.assigned_station_id.in_(list(deleted))
+        ).group_by(Student.assigned_station_id).all()
+        for station_id, count in riders:
+            deleted[station_id].unassigned_students += count
+    return diffs
+
+def apply_import(db: Session, diffs: List[RouteDiff]):
+    """Write a planned import with bulk statements in the caller's transaction; commit afterwards"""
+    deleted = [station_id for diff in diffs for station_id in diff.deletes]
+    updates = [row for diff in diffs for row in diff.updates]
+    inserts = [row for diff in diffs for row in diff.inserts]
+    if deleted:
+        db.execute(
+            update(Student).where(Student.assigned_station_id.in_(deleted)).values(assigned_station_id=None),
+            execution_options={"synchronize_session": False}
+        )
+        db.execute(
+            delete(StudentAlert).where(StudentAlert.station_id.in_(deleted)),
+            execution_options={"synchronize_session": False}
+        )
+        db.execute(
+            delete(Station).where(Station.id.in_(deleted)),
+            execution_options={"synchronize_session": False}
+        )
+    if updates:
+        # Bulk UPDATE by primary key
+        db.execute(update(Station), updates)
+    if inserts:
+        db.execute(insert(Station), inserts)
@@ -0,0 +1,105 @@
+"""
+Per-district placement of GPS location history
+
+Buses, stations, students and admins of every district share DATABASE_URL
+and are scoped by `district_id`. Location history is the hot,
+fast-growing table, so with LOCATION_SHARD_URL set each district's
+`bus_locations` lives in its own database: the template is formatted
+with the district id, e.g. `sqlite:///./locations_{district_id}.db`, or a
+Postgres URL selecting a per-district database or search_path. One
+district's morning rush then only contends for its own writes and
+indexes.
+
+Without LOCATION_SHARD_URL every district uses the primary and
+`LocationShards.session` hands back the caller's own session.
+"""
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+from sqlalchemy import MetaData, Table, Column, Index, UniqueConstraint
+from sqlalchemy.orm import Session, sessionmaker
+from database import Bus, BusLocation, create_instrumented_engine
+from config import LOCATION_SHARD_URL
+
+def _shard_table(metadata: MetaData) -> Table:
+    """bus_locations without its foreign key; buses stay on the primary"""
+    source = BusLocation.__table__
+    return Table(
+        source.name, metadata,
+        *(Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable) for c in source.columns),
+        *(Index(i.name, *(c.name for c in i.columns), unique=i.unique) for i in source.indexes),
+        *(
+            UniqueConstraint(*(c.name for c in constraint.columns), name=constraint.name)
+            for constraint in source.constraints if isinstance(constraint, UniqueConstraint)
+        ),
+    )
+
+shard_metadata = MetaData()
+_shard_table(shard_metadata)
+
+_sessionmakers: Dict[int, sessionmaker] = {}
+_sessionmakers_lock = threading.Lock()
+
+# bus_id -> district_id; buses never move between districts
+_bus_districts: Dict[int, int] = {}
+
+def sharding_enabled() -> bool:
+    return bool(LOCATION_SHARD_URL)
+
+def shard_sessionmaker(district_id: int) -> sessionmaker:
+    """Session factory for a district's shard, creating its engine and table on first use"""
+    factory = _sessionmakers.get(district_id)
+    if factory is None:
+        with _sessionmakers_lock:
+            factory = _sessionmakers.get(district_id)
+            if factory is None:
+                shard_engine = create_instrumented_engine(LOCATION_SHARD_URL.format(district_id=district_id))
+                # Districts added since the last `migrations.py upgrade` get their table here
+                shard_metadata.create_all(bind=shard_engine, checkfirst=True)
+                factory = sessionmaker(autocommit=False, autoflush=False, bind=shard_engine)
+                _sessionmakers[district_id] = factory
+    return factory
+
+def shard_engine(district_id: int):
+    return shard_sessionmaker(district_id).kw["bind"]
+
+def remember_districts(bus_districts: Iterable[Tuple[int, int]]):
+    _bus_districts.update(bus_districts)
+
+def district_of(db: Session, bus_id: int) -> Optional[int]:
+    district_id = _bus_districts.get(bus_id)
+    if district_id is None:
+        district_id = db.query(Bus.district_id).filter(Bus.id == bus_id).scalar()
+        if district_id is not None:
+            _bus_districts[bus_id] = district_id
+    return district_id
+
+class LocationShards:
+    """
+    Location-history sessions for one unit of work, opened per district on demand
+    Use as a context manager; shard sessions are closed on exit
+    """
+
+    def __init__(self, db: Session):
+        self.db = db
+        self._sessions: Dict[int, Session] = {}
+
+    def session(self, district_id: Optional[int]) -> Session:
+        if not LOCATION_SHARD_URL or district_id is None:
+            return self.db
+        if district_id not in self._sessions:
+            self._sessions[district_id] = shard_sessionmaker(district_id)()
+        return self._sessions[district_id]
+
+    def for_bus(self, bus_id: int) -> Session:
+        return self.session(district_of(self.db, bus_id))
+
+    def close(self):
+        for session in self._sessions.values():
+            session.close()
+        self._sessions.clear()
+
+    def __enter__(self) -> "LocationShards":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,337 @@
+"""
+Headless multi-bus GPS simulator
+
+Loads every bus's station sequence from the database and drives a virtual
+bus along each route, emitting GPS fixes to one of three sinks:
+
+    http       - one POST /bus/update per fix
+    batch      - POST /bus/update/batch with fixes grouped per flush
+    inprocess  - call ingest.ingest_locations directly (no HTTP stack)
+
+Example (morning rush, 10x real time, against a running server):
+
+    python simulator.py --sink batch --profile rush --time-scale 10 --duration 300
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import urllib.error
+import urllib.request
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from database import SessionLocal, Station
+from models import BusLocationCreate
+from utils import haversine_distance
+
+METERS_PER_DEGREE_LAT = 111320.0
+
+@dataclass
+class SpeedProfile:
+    cruise_kmh: float
+    min_kmh: float
+    max_kmh: float
+    jitter_kmh: float
+
+SPEED_PROFILES = {
+    "urban": SpeedProfile(cruise_kmh=25, min_kmh=5, max_kmh=40, jitter_kmh=8),
+    "suburban": SpeedProfile(cruise_kmh=40, min_kmh=15, max_kmh=60, jitter_kmh=6),
+    "rush": SpeedProfile(cruise_kmh=15, min_kmh=0, max_kmh=30, jitter_kmh=10),
+}
+
+@dataclass
+class VirtualBus:
+    bus_id: int
+    waypoints: List[Tuple[float, float]]
+    profile: SpeedProfile
+    segment: int = 0
+    offset_km: float = 0.0
+    dwell_remaining_s: float = 0.0
+    speed_kmh: float = 0.0
+    finished: bool = False
+    seq: int = 0
+    segment_lengths: List[float] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.segment_lengths = [
+            haversine_distance(a[0], a[1], b[0], b[1])
+            for a, b in zip(self.waypoints, self.waypoints[1:])
+        ]
+        self.speed_kmh = self.profile.cruise_kmh
+
+    def position(self) -> Tuple[float, float]:
+        if self.finished or self.segment >= len(self.segment_lengths):
+            return self.waypoints[-1]
+        start, end = self.waypoints[self.segment], self.waypoints[self.segment + 1]
+        length = self.segment_lengths[self.segment]
+        fraction = self.offset_km / length if length > 0 else 1.0
+        return (
+            start[0] + (end[0] - start[0]) * fraction,
+            start[1] + (end[1] - start[1]) * fraction,
+        )
+
+    def advance(self, seconds: float, dwell_range: Tuple[float, float], loop: bool):
+        """Move the bus along its route, pausing at each station"""
+        while seconds > 0 and not self.finished:
+            if self.dwell_remaining_s > 0:
+                waited = min(seconds, self.dwell_remaining_s)
+                self.dwell_remaining_s -= waited
+                seconds -= waited
+                continue
+
+            # Random walk around the cruise speed, clamped to the profile
+            self.speed_kmh += random.uniform(-self.profile.jitter_kmh, self.profile.jitter_kmh)
+            self.speed_kmh += (self.profile.cruise_kmh - self.speed_kmh) * 0.2
+            self.speed_kmh = min(max(self.speed_kmh, self.profile.min_kmh), self.profile.max_kmh)
+            if self.speed_kmh <= 0:
+                # Stuck in traffic for the rest of this tick
+                return
+
+            remaining_km = self.segment_lengths[self.segment] - self.offset_km
+            travel_km = self.speed_kmh * seconds / 3600
+            if travel_km < remaining_km:
+                self.offset_km += travel_km
+                return
+
+            # Reached the next station: consume the time it took and dwell
+            seconds -= remaining_km / self.speed_kmh * 3600
+            self.segment += 1
+            self.offset_km = 0.0
+            self.dwell_remaining_s = random.uniform(*dwell_range)
+            if self.segment >= len(self.segment_lengths):
+                if loop:
+                    self.segment = 0
+                else:
+                    self.finished = True
+
+def add_gps_noise(lat: float, lon: float, noise_m: float) -> Tuple[float, float]:
+    """Apply gaussian GPS error with the given standard deviation in meters"""
+    if noise_m <= 0:
+        return lat, lon
+    dlat = random.gauss(0, noise_m) / METERS_PER_DEGREE_LAT
+    dlon = random.gauss(0, noise_m) / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(lat)), 1e-6))
+    return lat + dlat, lon + dlon
+
+def load_routes(bus_ids: Optional[List[int]] = None) -> Dict[int, List[Tuple[float, float]]]:
+    """Load ordered station coordinates for every bus with a usable route"""
+    db = SessionLocal()
+    try:
+        query = db.query(Station)
+        if bus_ids:
+            query = query.filter(Station.bus_id.in_(bus_ids))
+        stations = query.order_by(Station.bus_id, Station.order_number).all()
+    finally:
+        db.close()
+
+    routes: Dict[int, List[Tuple[float, float]]] = {}
+    for station in stations:
+        routes.setdefault(station.bus_id, []).append((station.latitude, station.longitude))
+    # A route needs at least two stops to drive along
+    return {bus_id: points for bus_id, points in routes.items() if len(points) >= 2}
+
+class SimulatorStats:
+    def __init__(self):
+        self.sent = 0
+        self.errors = 0
+        self.shed = 0  # Refused by the server's admission control (429/503)
+        self.requests = 0
+        self.latencies: List[float] = []
+
+    def summary(self, elapsed: float) -> str:
+        latencies = sorted(self.latencies)
+        if latencies:
+            p50 = latencies[len(latencies) // 2] * 1000
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+        else:
+            p50 = p99 = 0.0
+        rate = self.sent / elapsed if elapsed > 0 else 0.0
+        return (
+            f"fixes sent={self.sent} errors={self.errors} shed={self.shed} requests={self.requests} "
+            f"rate={rate:.1f}/s p50={p50:.1f}ms p99={p99:.1f}ms"
+        )
+
+def _post_json(url: str, payload, timeout: float):
+    request = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode(),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        response.read()
+
+def _fix_payload(fix: BusLocationCreate) -> dict:
+    return {
+        "bus_id": fix.bus_id,
+        "latitude": fix.latitude,
+        "longitude": fix.longitude,
+        "timestamp": fix.timestamp.isoformat() if fix.timestamp else None,
+        "device_id": fix.device_id,
+        "seq": fix.seq,
+    }
+
+class HttpSink:
+    """POST each fix to /bus/update"""
+    batched = False
+
+    def __init__(self, base_url: str, timeout: float = 10.0):
+        self.url = base_url.rstrip("/") + "/bus/update"
+        self.timeout = timeout
+
+    def send(self, fixes: List[BusLocationCreate]):
+        for fix in fixes:
+            _post_json(self.url, _fix_payload(fix), self.timeout)
+
+class BatchHttpSink:
+    """POST groups of fixes to /bus/update/batch"""
+    batched = True
+
+    def __init__(self, base_url: str, timeout: float = 10.0):
+        self.url = base_url.rstrip("/") + "/bus/update/batch"
+        self.timeout = timeout
+
+    def send(self, fixes: List[BusLocationCreate]):
+        _post_json(self.url, {"locations": [_fix_payload(fix) for fix in fixes]}, self.timeout)
+
+class InProcessSink:
+    """Call the ingest function directly with a fresh session per flush"""
+    batched = True
+
+    def send(self, fixes: List[BusLocationCreate]):
+        from ingest import ingest_locations
+        db = SessionLocal()
+        try:
+            ingest_locations(db, fixes)
+        finally:
+            db.close()
+
+class Simulator:
+    def __init__(
+        self,
+        routes: Dict[int, List[Tuple[float, float]]],
+        sink,
+        profile: SpeedProfile,
+        interval_s: float = 5.0,
+        time_scale: float = 1.0,
+        dwell_range: Tuple[float, float] = (20.0, 60.0),
+        noise_m: float = 5.0,
+        loop: bool = True,
+        concurrency: int = 8,
+        batch_size: int = 200,
+    ):
+        self.buses = [VirtualBus(bus_id, points, profile) for bus_id, points in routes.items()]
+        self.sink = sink
+        self.interval_s = interval_s
+        self.time_scale = time_scale
+        self.dwell_range = dwell_range
+        self.noise_m = noise_m
+        self.loop = loop
+        self.concurrency = concurrency
+        self.batch_size = batch_size if sink.batched else 1
+        self.stats = SimulatorStats()
+
+    async def _drive(self, bus: VirtualBus, queue: asyncio.Queue, deadline: float):
+        # Stagger start times so fixes don't arrive in lockstep
+        await asyncio.sleep(random.uniform(0, self.interval_s / self.time_scale))
+        while not bus.finished and time.monotonic() < deadline:
+            bus.advance(self.interval_s, self.dwell_range, self.loop)
+            lat, lon = add_gps_noise(*bus.position(), self.noise_m)
+            bus.seq += 1
+            await queue.put(BusLocationCreate(
+                bus_id=bus.bus_id,
+                latitude=lat,
+                longitude=lon,
+                timestamp=datetime.utcnow(),
+                device_id=f"sim-{bus.bus_id}",
+                seq=bus.seq
+            ))
+            await asyncio.sleep(self.interval_s / self.time_scale)
+
+    async def _deliver(self, queue: asyncio.Queue):
+        while True:
+            fixes = [await queue.get()]
+            while len(fixes) < self.batch_size and not queue.empty():
+                fixes.append(queue.get_nowait())
+            started = time.perf_counter()
+            backoff = 0.0
+            try:
+                await asyncio.to_thread(self.sink.send, fixes)
+                self.stats.sent += len(fixes)
+            except urllib.error.HTTPError as exc:
+                if exc.code not in (429, 503):
+                    self.stats.errors += len(fixes)
+                    print(f"send failed for {len(fixes)} fixes: {exc}")
+                else:
+                    # Back off as the server asks; the fixes are dropped like a real tracker would
+                    self.stats.shed += len(fixes)
+                    backoff = float(exc.headers.get("Retry-After") or 1)
+            except Exception as exc:
+                self.stats.errors += len(fixes)
+                print(f"send failed for {len(fixes)} fixes: {exc}")
+            finally:
+                self.stats.requests += 1
+                self.stats.latencies.append(time.perf_counter() - started)
+                for _ in fixes:
+                    queue.task_done()
+            if backoff:
+                await asyncio.sleep(backoff)
+
+    async def run(self, duration_s: float) -> SimulatorStats:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=max(len(self.buses) * 4, 100))
+        deadline = time.monotonic() + duration_s
+        workers = [asyncio.create_task(self._deliver(queue)) for _ in range(self.concurrency)]
+        await asyncio.gather(*(self._drive(bus, queue, deadline) for bus in self.buses))
+        await queue.join()
+        for worker in workers:
+            worker.cancel()
+        return self.stats
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive virtual buses along their station routes")
+    parser.add_argument("--sink", choices=["http", "batch", "inprocess"], default="http")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--buses", type=int, nargs="*", help="Bus ids to simulate (default: all)")
+    parser.add_argument("--profile", choices=sorted(SPEED_PROFILES), default="urban")
+    parser.add_argument("--interval", type=float, default=5.0, help="Simulated seconds between fixes")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="Simulated seconds per wall second")
+    parser.add_argument("--duration", type=float, default=60.0, help="Wall-clock run time in seconds")
+    parser.add_argument("--dwell", type=float, nargs=2, default=[20.0, 60.0], metavar=("MIN", "MAX"))
+    parser.add_argument("--noise-m", type=float, default=5.0, help="GPS noise standard deviation in meters")
+    parser.add_argument("--no-loop", action="store_true", help="Stop each bus at the end of its route")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=200)
+    args = parser.parse_args()
+
+    routes = load_routes(args.buses)
+    if not routes:
+        parser.error("no buses with at least two stations found")
+
+    if args.sink == "http":
+        sink = HttpSink(args.base_url)
+    elif args.sink == "batch":
+        sink = BatchHttpSink(args.base_url)
+    else:
+        sink = InProcessSink()
+
+    simulator = Simulator(
+        routes,
+        sink,
+        SPEED_PROFILES[args.profile],
+        interval_s=args.interval,
+        time_scale=args.time_scale,
+        dwell_range=tuple(args.dwell),
+        noise_m=args.noise_m,
+        loop=not args.no_loop,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+    )
+    print(f"simulating {len(simulator.buses)} buses via {args.sink} sink for {args.duration:.0f}s")
+    started = time.monotonic()
+    stats = asyncio.run(simulator.run(args.duration))
+    print(stats.summary(time.monotonic() - started))
+
+if __name__ == "__main__":
+    main()
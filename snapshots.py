@@ -0,0 +1,158 @@
+"""
+Per-bus station status snapshots
+
+Station statuses depend only on the bus's route and latest fix, not on
+who is asking, so they are computed once per accepted fix (see ingest.py)
+and every student request on that bus slices the same snapshot.
+
+Snapshots live in process memory. Readers rebuild one that is older than
+SNAPSHOT_MAX_AGE_SECONDS, which keeps workers that did not receive the fix
+close to current; with SNAPSHOT_PERSIST the rebuild first tries the copy
+that the ingesting worker wrote to `bus_status_snapshots`.
+"""
+import json
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+from sqlalchemy.orm import Session
+from database import Station, BusLocation, BusStatusSnapshot
+from sharding import LocationShards
+from utils import compute_station_statuses
+from config import SNAPSHOT_MAX_AGE_SECONDS, SNAPSHOT_PERSIST
+import metrics
+
+class BusSnapshot:
+    def __init__(self, bus_id: int, location: Optional[dict], stations: List[dict], updated_at: datetime):
+        self.bus_id = bus_id
+        self.location = location
+        self.stations = stations
+        self.updated_at = updated_at
+        self.loaded_at = time.monotonic()
+        self._by_station = {station["id"]: station for station in stations}
+
+    def station(self, station_id: int) -> Optional[dict]:
+        return self._by_station.get(station_id)
+
+    def to_json(self) -> str:
+        location = dict(self.location) if self.location else None
+        if location:
+            location["timestamp"] = location["timestamp"].isoformat()
+        return json.dumps({"location": location, "stations": self.stations})
+
+    @classmethod
+    def from_json(cls, bus_id: int, payload: str, updated_at: datetime) -> "BusSnapshot":
+        data = json.loads(payload)
+        location = data["location"]
+        if location:
+            location["timestamp"] = datetime.fromisoformat(location["timestamp"])
+        return cls(bus_id, location, data["stations"], updated_at)
+
+_snapshots: Dict[int, BusSnapshot] = {}
+_build_locks: Dict[int, threading.Lock] = defaultdict(threading.Lock)
+
+def _location_dict(location: Optional[BusLocation]) -> Optional[dict]:
+    if not location:
+        return None
+    return {
+        "id": location.id,
+        "bus_id": location.bus_id,
+        "latitude": location.latitude,
+        "longitude": location.longitude,
+        "timestamp": location.timestamp,
+        "seq": location.seq,
+    }
+
+def latest_location(db: Session, bus_id: int) -> Optional[BusLocation]:
+    with LocationShards(db) as shards:
+        return shards.for_bus(bus_id).query(BusLocation).filter(
+            BusLocation.bus_id == bus_id,
+            BusLocation.out_of_order.is_(False)
+        ).order_by(BusLocation.timestamp.desc()).first()
+
+def build_snapshot(db: Session, bus_id: int, location: Optional[BusLocation] = None) -> BusSnapshot:
+    """Compute statuses for every station of the bus from one route query"""
+    stations = db.query(Station).filter(Station.bus_id == bus_id).order_by(Station.order_number).all()
+    if location is None:
+        location = latest_location(db, bus_id)
+
+    statuses = compute_station_statuses(location, stations)
+    station_data = [
+        {
+            "id": station.id,
+            "name": station.name,
+            "latitude": station.latitude,
+            "longitude": station.longitude,
+            "bus_id": station.bus_id,
+            "order_number": station.order_number,
+            "status": status,
+            "eta_minutes": eta
+        }
+        for station, (status, eta) in zip(stations, statuses)
+    ]
+    return BusSnapshot(bus_id, _location_dict(location), station_data, datetime.utcnow())
+
+def refresh_bus(db: Session, bus_id: int, location: BusLocation) -> BusSnapshot:
+    """Rebuild the snapshot for a newly stored fix (called from ingest)"""
+    current = _snapshots.get(bus_id)
+    if current and current.location and location.timestamp < current.location["timestamp"]:
+        # An older fix arrived late; the live position doesn't move back
+        return current
+
+    snapshot = build_snapshot(db, bus_id, location)
+    _snapshots[bus_id] = snapshot
+    if SNAPSHOT_PERSIST:
+        db.merge(BusStatusSnapshot(
+            bus_id=bus_id,
+            location_id=location.id,
+            payload=snapshot.to_json(),
+            updated_at=snapshot.updated_at
+        ))
+        db.commit()
+    return snapshot
+
+def get_snapshot(db: Session, bus_id: int) -> BusSnapshot:
+    """Current snapshot for a bus, rebuilding it at most once per max age"""
+    snapshot = _snapshots.get(bus_id)
+    if snapshot and time.monotonic() - snapshot.loaded_at < SNAPSHOT_MAX_AGE_SECONDS:
+        metrics.record_cache("bus_snapshot", True)
+        return snapshot
+
+    # One rebuild per bus at a time; concurrent readers wait and reuse it
+    with _build_locks[bus_id]:
+        snapshot = _snapshots.get(bus_id)
+        if snapshot and time.monotonic() - snapshot.loaded_at < SNAPSHOT_MAX_AGE_SECONDS:
+            metrics.record_cache("bus_snapshot", True)
+            return snapshot
+        metrics.record_cache("bus_snapshot", False)
+
+        if SNAPSHOT_PERSIST:
+            row = db.get(BusStatusSnapshot, bus_id)
+            if row and (not snapshot or row.updated_at > snapshot.updated_at):
+                snapshot = BusSnapshot.from_json(bus_id, row.payload, row.updated_at)
+                _snapshots[bus_id] = snapshot
+                return snapshot
+
+        rebuilt = build_snapshot(db, bus_id)
+        if snapshot and snapshot.location and (
+            not rebuilt.location or rebuilt.location["timestamp"] < snapshot.location["timestamp"]
+        ):
+            # A lagging read replica is behind the fix this worker ingested
+            snapshot.loaded_at = time.monotonic()
+            return snapshot
+        _snapshots[bus_id] = rebuilt
+        return rebuilt
+
+def invalidate(db: Session, bus_ids: Iterable[int]):
+    """
+    Drop snapshots after a route change
+    Persisted rows are deleted in the caller's transaction; commit afterwards
+    """
+    bus_ids = list(bus_ids)
+    for bus_id in bus_ids:
+        _snapshots.pop(bus_id, None)
+    if SNAPSHOT_PERSIST and bus_ids:
+        db.query(BusStatusSnapshot).filter(
+            BusStatusSnapshot.bus_id.in_(bus_ids)
+        ).delete(synchronize_session=False)
@@ -1,55 +1,30 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
 from typing import List, Optional
-from database import get_db, Station, Bus, BusLocation
-from models import StationWithStatus, BusResponse, BusLocationResponse
+from database import get_read_db, Bus, StudentAlert
+from models import StationWithStatus, BusResponse, BusLocationResponse, StudentAlertResponse
 from auth import get_current_student
-from utils import determine_station_status
+from snapshots import get_snapshot
 
 router = APIRouter(prefix="/student", tags=["student"])
 
 @router.get("/stations/{bus_id}", response_model=List[StationWithStatus])
 def get_stations_with_status(
     bus_id: int,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_student = Depends(get_current_student)
 ):
     # Verify student has access to this bus
     if current_student.assigned_bus_id != bus_id:
         raise HTTPException(status_code=403, detail="Access denied to this bus")
     
-    # Get all stations for the bus
-    stations = db.query(Station).filter(Station.bus_id == bus_id).order_by(Station.order_number).all()
-    if not stations:
-        return []
-    
-    # Get latest bus location
-    latest_location = db.query(BusLocation).filter(
-        BusLocation.bus_id == bus_id
-    ).order_by(BusLocation.timestamp.desc()).first()
-    
-    stations_with_status = []
-    for station in stations:
-        status, eta = determine_station_status(latest_location, station, stations)
-        
-        station_data = {
-            "id": station.id,
-            "name": station.name,
-            "latitude": station.latitude,
-            "longitude": station.longitude,
-            "bus_id": station.bus_id,
-            "order_number": station.order_number,
-            "status": status,
-            "eta_minutes": eta
-        }
-        stations_with_status.append(StationWithStatus(**station_data))
-    
-    return stations_with_status
+    # Statuses are computed once per fix and shared by every rider
+    return get_snapshot(db, bus_id).stations
 
 @router.get("/bus/{bus_id}", response_model=BusResponse)
 def get_bus_info(
     bus_id: int,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_student = Depends(get_current_student)
 ):
     # Verify student has access to this bus
@@ -65,25 +40,18 @@ def get_bus_info(
 @router.get("/bus/{bus_id}/location", response_model=Optional[BusLocationResponse])
 def get_bus_location(
     bus_id: int,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_student = Depends(get_current_student)
 ):
     # Verify student has access to this bus
     if current_student.assigned_bus_id != bus_id:
         raise HTTPException(status_code=403, detail="Access denied to this bus")
     
-    latest_location = db.query(BusLocation).filter(
-        BusLocation.bus_id == bus_id
-    ).order_by(BusLocation.timestamp.desc()).first()
-    
-    if not latest_location:
-        return None
-    
-    return latest_location
+    return get_snapshot(db, bus_id).location
 
 @router.get("/my-bus", response_model=Optional[BusResponse])
 def get_my_bus(
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_student = Depends(get_current_student)
 ):
     if not current_student.assigned_bus_id:
@@ -94,35 +62,25 @@ def get_my_bus(
 
 @router.get("/my-station", response_model=Optional[StationWithStatus])
 def get_my_station_status(
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_student = Depends(get_current_student)
 ):
     if not current_student.assigned_station_id or not current_student.assigned_bus_id:
         return None
     
-    station = db.query(Station).filter(Station.id == current_student.assigned_station_id).first()
-    if not station:
-        return None
-    
-    # Get all stations for route calculation
-    all_stations = db.query(Station).filter(
-        Station.bus_id == current_student.assigned_bus_id
-    ).order_by(Station.order_number).all()
-    
-    # Get latest bus location
-    latest_location = db.query(BusLocation).filter(
-        BusLocation.bus_id == current_student.assigned_bus_id
-    ).order_by(BusLocation.timestamp.desc()).first()
-    
-    status, eta = determine_station_status(latest_location, station, all_stations)
-    
-    return StationWithStatus(
-        id=station.id,
-        name=station.name,
-        latitude=station.latitude,
-        longitude=station.longitude,
-        bus_id=station.bus_id,
-        order_number=station.order_number,
-        status=status,
-        eta_minutes=eta
-    )
\ No newline at end of file
+    # A station that isn't on the assigned bus's route has no status
+    snapshot = get_snapshot(db, current_student.assigned_bus_id)
+    return snapshot.station(current_student.assigned_station_id)
+
+@router.get("/alerts", response_model=List[StudentAlertResponse])
+def get_my_alerts(
+    after_id: int = 0,
+    limit: int = Query(50, ge=1, le=200),
+    db: Session = Depends(get_read_db),
+    current_student = Depends(get_current_student)
+):
+    """Approaching/arrived alerts for the student's stop, oldest first after `after_id`"""
+    return db.query(StudentAlert).filter(
+        StudentAlert.student_id == current_student.id,
+        StudentAlert.id > after_id
+    ).order_by(StudentAlert.id).limit(limit).all()
\ No newline at end of file
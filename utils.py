@@ -1,5 +1,5 @@
 import math
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 from datetime import datetime
 from database import Station, BusLocation
 from config import AVERAGE_BUS_SPEED_KMH, APPROACHING_DISTANCE_KM
@@ -57,6 +57,50 @@ def determine_station_status(bus_location: BusLocation, station: Station, statio
     eta = calculate_eta_minutes(route_distance)
     return "waiting", eta
 
+def compute_station_statuses(bus_location: BusLocation, stations: List[Station]) -> List[Tuple[str, Optional[int]]]:
+    """
+    Status and ETA for every station of a route in one pass
+    Same results as calling determine_station_status for each station,
+    but the closest station and segment distances are computed once
+    """
+    if not bus_location:
+        return [("waiting", None) for _ in stations]
+    if not stations:
+        return []
+    
+    sorted_stations = sorted(stations, key=lambda x: x.order_number)
+    distances = {
+        station.id: haversine_distance(
+            bus_location.latitude, bus_location.longitude,
+            station.latitude, station.longitude
+        )
+        for station in stations
+    }
+    segments = [
+        haversine_distance(a.latitude, a.longitude, b.latitude, b.longitude)
+        for a, b in zip(sorted_stations, sorted_stations[1:])
+    ]
+    
+    # Closest station as seen by the passed check and by the route walk
+    closest_station = min(stations, key=lambda x: distances[x.id])
+    route_closest = min(sorted_stations, key=lambda x: distances[x.id])
+    closest_idx = next(i for i, s in enumerate(sorted_stations) if s.id == route_closest.id)
+    positions = {station.id: i for i, station in reversed(list(enumerate(sorted_stations)))}
+    
+    results = []
+    for station in stations:
+        if closest_station.order_number > station.order_number:
+            results.append(("passed", 0))
+        elif distances[station.id] <= APPROACHING_DISTANCE_KM:
+            results.append(("approaching", calculate_eta_minutes(distances[station.id])))
+        elif station.order_number <= route_closest.order_number:
+            results.append(("waiting", calculate_eta_minutes(0)))
+        else:
+            # Bus to closest station, then along the route to the target
+            route_distance = sum(segments[closest_idx:positions[station.id]], distances[route_closest.id])
+            results.append(("waiting", calculate_eta_minutes(route_distance)))
+    return results
+
 def find_closest_station_to_bus(bus_location: BusLocation, stations: List[Station]) -> Station:
     """Find the station closest to the current bus location"""
     if not stations: